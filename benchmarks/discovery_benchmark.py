@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Measures how long discovery takes to resolve every device as the number of
+devices on the network grows.
+
+An in-process zeroconf responder advertises the simulated devices on the
+local machine, and each service info lookup is delayed by <latency-ms> to
+stand in for slow or lossy links. Times are shown both for resolving one
+service at a time, which is what a single browser callback thread does, and
+for the discoverer's resolver pool.
+
+Usage: python3 benchmarks/discovery_benchmark.py [<max-devices> [<latency-ms>]]
+
+
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import socket
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from zeroconf import ServiceInfo, Zeroconf
+
+from mdt import discoverer
+
+
+def Advertise(zeroconf, first, count):
+    infos = []
+    for index in range(first, count):
+        name = 'bench{0}'.format(index)
+        infos.append(ServiceInfo(
+            discoverer.Discoverer.SERVICE_TYPE,
+            '{0}.{1}'.format(name, discoverer.Discoverer.SERVICE_TYPE),
+            addresses=[socket.inet_aton('127.0.0.1')],
+            port=22,
+            properties={'serial': name},
+            server='{0}.local.'.format(name)))
+
+    # Registration probes the network for name conflicts first, which takes a
+    # couple of seconds per service, so register them all at once.
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        list(executor.map(zeroconf.register_service, infos))
+    return infos
+
+
+def SlowLookups(latency):
+    get_service_info = Zeroconf.get_service_info
+
+    def delayed(self, *args, **kwargs):
+        time.sleep(latency)
+        return get_service_info(self, *args, **kwargs)
+
+    Zeroconf.get_service_info = delayed
+
+
+def TimeDiscovery(count, workers):
+    discoverer.RESOLVE_WORKERS = workers
+    browser = discoverer.Discoverer()
+    start = time.time()
+    browser.discover(lambda hostname: len(browser.discoveries) >= count,
+                     timeout=120)
+    elapsed = time.time() - start
+    if len(browser.discoveries) < count:
+        return None
+    return elapsed
+
+
+def main():
+    max_devices = 32
+    latency = 0.2
+    if len(sys.argv) > 1:
+        max_devices = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = int(sys.argv[2]) / 1000.0
+
+    SlowLookups(latency)
+    pool_size = discoverer.RESOLVE_WORKERS
+    responder = Zeroconf()
+
+    print('{0:>8} {1:>12} {2:>12}'.format('devices', 'serial (ms)',
+                                          'pooled (ms)'))
+    advertised = 0
+    count = 1
+    try:
+        while count <= max_devices:
+            Advertise(responder, advertised, count)
+            advertised = count
+
+            times = [TimeDiscovery(count, workers)
+                     for workers in (1, pool_size)]
+            print('{0:>8} {1:>12} {2:>12}'.format(
+                count, *['{0:.1f}'.format(t * 1000) if t is not None
+                         else 'timeout' for t in times]))
+            count *= 2
+    finally:
+        responder.unregister_all_services()
+        responder.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""Measures how quickly `mdt exec cat <large-file>` output gets to stdout, and
+how quickly `... | mdt exec cat` gets data through to the device and back.
+
+The remote end is an in-process paramiko server over a socketpair that answers
+`cat large-file` by sending the requested number of bytes, and `cat` by echoing
+its input, so the numbers cover SSH framing, encryption and MDT's own data paths
+without any network latency. Reading the channel directly, without the console,
+is shown for comparison. The mux cases relay the channel through a multiplexer
+master over a unix socketpair, as happens with the multiplex variable set.
+
+Usage: python3 benchmarks/exec_benchmark.py [<megabytes>] [<iterations>]
+
+
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+
+from mdt import api
+from mdt import console
+from mdt import multiplexer
+
+
+BLOCK_SIZE = 32768
+
+# Mostly multibyte UTF-8, which used to get dropped when split across reads.
+BLOCK = ('ü€ mendel \n' * BLOCK_SIZE).encode('utf-8')[:BLOCK_SIZE]
+
+
+class CatServer(paramiko.ServerInterface):
+    def __init__(self, size):
+        self.size = size
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        target = self._echo if command == b'cat' else self._cat
+        threading.Thread(target=target, args=(channel,)).start()
+        return True
+
+    def _echo(self, channel):
+        while True:
+            data = channel.recv(BLOCK_SIZE)
+            if not data:
+                break
+            channel.sendall(data)
+        channel.send_exit_status(0)
+        channel.close()
+
+    def _cat(self, channel):
+        remaining = self.size
+        while remaining > 0:
+            channel.sendall(BLOCK[:remaining])
+            remaining -= BLOCK_SIZE
+        channel.send_exit_status(0)
+        channel.close()
+
+
+class PipedStdout:
+    '''Stands in for sys.stdout with a pipe to a thread that counts what's
+    written, like a consumer piped to mdt exec.'''
+
+    def __init__(self):
+        read_fd, self.write_fd = os.pipe()
+        self.buffer = os.fdopen(self.write_fd, 'wb', closefd=False)
+        self.count = 0
+        self.reader = threading.Thread(target=self._read, args=(read_fd,))
+        self.reader.start()
+
+    def _read(self, fd):
+        while True:
+            data = os.read(fd, BLOCK_SIZE)
+            if not data:
+                break
+            self.count += len(data)
+        os.close(fd)
+
+    def fileno(self):
+        return self.write_fd
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.buffer.close()
+        os.close(self.write_fd)
+        self.reader.join()
+
+
+def ReadWithConsole(channel, size):
+    read_fd, write_fd = os.pipe()
+    stdout = sys.stdout
+    sys.stdout = PipedStdout()
+    try:
+        with os.fdopen(read_fd, 'rb') as inputfile:
+            console.Console(channel, inputfile).run()
+    except console.ConnectionClosedError:
+        pass
+    finally:
+        piped = sys.stdout
+        sys.stdout = stdout
+        piped.close()
+        os.close(write_fd)
+    return piped.count
+
+
+def ReadDirectly(channel, size):
+    count = 0
+    while True:
+        data = channel.recv(BLOCK_SIZE)
+        if not data:
+            return count
+        count += len(data)
+
+
+def PipeThrough(channel, size):
+    '''Streams size bytes into the command from a pipe, the way mdt exec does
+    with piped stdin, and counts what comes back.'''
+
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        remaining = size
+        while remaining > 0:
+            remaining -= os.write(write_fd, BLOCK[:remaining])
+        os.close(write_fd)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    count = 0
+
+    def count_stdout(data):
+        nonlocal count
+        count += len(data)
+
+    try:
+        api.StreamChannel(channel, count_stdout, lambda data: None, read_fd)
+    finally:
+        writer.join()
+        os.close(read_fd)
+    return count
+
+
+def Multiplexed(reader):
+    '''Returns reader wrapped so that it reads and writes the channel through a
+    multiplexer master's pump.'''
+
+    def read(channel, size):
+        master_sock, client_sock = socket.socketpair()
+        master = multiplexer.MultiplexMaster('benchmark', None)
+        pump = threading.Thread(target=master._pump,
+                                args=(master_sock, channel))
+        pump.start()
+        mux = multiplexer.MultiplexChannel(client_sock)
+        try:
+            return reader(mux, size)
+        finally:
+            pump.join()
+            mux.close()
+            master_sock.close()
+
+    return read
+
+
+def Cat(size, reader, piped):
+    server_sock, client_sock = socket.socketpair()
+    server = paramiko.Transport(server_sock)
+    server.add_server_key(HOST_KEY)
+    thread = threading.Thread(target=server.start_server,
+                              kwargs={'server': CatServer(size)})
+    thread.start()
+
+    client = paramiko.Transport(client_sock)
+    client.start_client()
+    client.auth_none('mendel')
+
+    channel = client.open_session()
+    if not piped:
+        channel.get_pty()
+    start = time.time()
+    channel.exec_command('cat' if piped else 'cat large-file')
+    count = reader(channel, size)
+    elapsed = time.time() - start
+
+    # Let the server's close arrive before dropping the connection under it.
+    while not channel.closed:
+        time.sleep(0.01)
+    client.close()
+    server.close()
+    thread.join()
+    if count != size:
+        raise RuntimeError('Expected {0} bytes, got {1}'.format(size, count))
+    return elapsed
+
+
+def main():
+    global HOST_KEY
+
+    megabytes = 64
+    iterations = 3
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        iterations = int(sys.argv[2])
+
+    HOST_KEY = paramiko.RSAKey.generate(bits=2048)
+    size = megabytes * 1024 * 1024
+
+    print('{0:<10} {1:>10} {2:>10}'.format('reader', 'time (s)', 'MB/s'))
+    for name, reader, piped in [
+            ('channel', ReadDirectly, False),
+            ('console', ReadWithConsole, False),
+            ('mux', Multiplexed(ReadWithConsole), False),
+            ('pipe', PipeThrough, True),
+            ('mux-pipe', Multiplexed(PipeThrough), True)]:
+        elapsed = min(Cat(size, reader, piped) for i in range(iterations))
+        print('{0:<10} {1:>10.2f} {2:>10.1f}'.format(name, elapsed,
+                                                     megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Compares key generation and SSH handshake time across MDT key types.
+
+Handshakes are run against an in-process paramiko server over a socketpair,
+so the numbers cover key exchange and public key authentication only, without
+any network latency.
+
+Usage: python3 benchmarks/keys_benchmark.py [<iterations>]
+
+
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+from mdt import keys
+
+
+class BenchmarkServer(paramiko.ServerInterface):
+    def __init__(self, client_key):
+        self.client_key = client_key
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() == self.client_key.get_base64():
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+
+def Handshake(host_key, client_key):
+    server_sock, client_sock = socket.socketpair()
+    server = paramiko.Transport(server_sock)
+    server.add_server_key(host_key)
+    thread = threading.Thread(target=server.start_server,
+                              kwargs={'server': BenchmarkServer(client_key)})
+    thread.start()
+
+    client = paramiko.Transport(client_sock)
+    start = time.time()
+    client.start_client()
+    client.auth_publickey('mendel', client_key)
+    elapsed = time.time() - start
+
+    client.close()
+    server.close()
+    thread.join()
+    return elapsed
+
+
+def main():
+    iterations = 5
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    host_key = paramiko.RSAKey.generate(bits=2048)
+    workdir = tempfile.mkdtemp()
+    keys.KEYSDIR = workdir
+    keys.KEYFILE_PATH = os.path.join(workdir, 'mdt.key')
+    keys.AUTHSTATE_PATH = os.path.join(workdir, 'authstate')
+
+    print('{0:<10} {1:>12} {2:>14}'.format('key type', 'keygen (ms)',
+                                          'handshake (ms)'))
+    for keytype in keys.KEY_TYPES:
+        keystore = keys.Keystore()
+
+        keygen_time = 0
+        for i in range(iterations):
+            start = time.time()
+            try:
+                keystore.generateKey(keytype)
+            except keys.KeystoreError:
+                break
+            keygen_time += time.time() - start
+        else:
+            handshake_time = sum(Handshake(host_key, keystore.key())
+                                 for i in range(iterations))
+            print('{0:<10} {1:>12.1f} {2:>14.1f}'.format(
+                keytype,
+                keygen_time * 1000 / iterations,
+                handshake_time * 1000 / iterations))
+
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
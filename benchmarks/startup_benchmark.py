@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""Measures how long MDT takes to start up for each subcommand.
+
+Each sample runs a fresh interpreter that imports mdt.main and loads a single
+subcommand, the same way mdt does before running it, so the numbers cover
+module imports and command construction but no network activity. The time
+taken to start a bare interpreter is shown first for comparison.
+
+Usage: python3 benchmarks/startup_benchmark.py [<iterations>] [<subcommand>...]
+
+
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from mdt import main as mdt_main
+
+
+LOAD_COMMAND = 'from mdt import main; main.LoadCommand({0!r})'
+
+
+def TimeStartup(code, iterations):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [path for path in [env.get('PYTHONPATH')] if path])
+
+    samples = []
+    for i in range(iterations):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-W', 'ignore', '-c', code],
+                              env=env)
+        samples.append(time.time() - start)
+    return samples
+
+
+def main():
+    iterations = 10
+    names = sorted(mdt_main.COMMANDS)
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        names = sys.argv[2:]
+
+    print('{0:<18} {1:>12} {2:>12}'.format('subcommand', 'median (ms)',
+                                          'max (ms)'))
+    for name, code in [('(interpreter)', 'pass')] + \
+            [(name, LOAD_COMMAND.format(name)) for name in names]:
+        samples = TimeStartup(code, iterations)
+        print('{0:<18} {1:>12.1f} {2:>12.1f}'.format(
+            name, statistics.median(samples) * 1000, max(samples) * 1000))
+
+
+if __name__ == '__main__':
+    main()
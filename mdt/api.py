@@ -0,0 +1,266 @@
+'''
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+asyncio API for driving devices from other Python programs, such as test
+harnesses. Nothing in here prints or exits; errors are raised as the
+exceptions defined by sshclient, keys and discoverer, or by paramiko.
+
+Paramiko is a blocking library, so the blocking parts of each call run in an
+executor. Idle devices don't hold on to executor threads.
+
+Example:
+
+    async def main():
+        devices = await api.discover()
+        async with api.Device(name, devices[name]) as device:
+            result = await device.exec('uname -a')
+            print(result.exit_status, result.stdout)
+'''
+
+
+import asyncio
+import collections
+import functools
+import os
+import select
+import socket
+import threading
+
+from mdt import config
+from mdt import discoverer
+from mdt import sshclient
+
+
+STDIN_BUFFER_SIZE = 65536
+
+ExecResult = collections.namedtuple('ExecResult',
+                                    ['exit_status', 'stdout', 'stderr'])
+
+
+def StreamChannel(channel, on_stdout, on_stderr, stdin=None):
+    '''Blocks until the command running on channel exits, passing its output
+    to on_stdout and on_stderr as it arrives. Returns the exit status.
+
+    If stdin is a file descriptor, everything read from it is sent to the
+    command as its input, as fast as the remote window allows, followed by an
+    EOF. Whatever is left of it once the command closes the channel is
+    dropped.'''
+
+    channel.settimeout(0)
+    pending = b''
+    while True:
+        readers = [channel]
+        if stdin is not None and not pending:
+            readers.append(stdin)
+        timeout = sshclient.SEND_RETRY_SECS if pending else None
+        ready, _, _ = select.select(readers, [], [], timeout)
+
+        if stdin is not None and (channel.closed or channel.eof_received):
+            pending = b''
+            stdin = None
+
+        if stdin is not None and stdin in ready:
+            pending = os.read(stdin, STDIN_BUFFER_SIZE)
+            if not pending:
+                channel.shutdown_write()
+                stdin = None
+        while pending and channel.send_ready():
+            try:
+                sent = channel.send(pending)
+            except socket.timeout:
+                break
+            except socket.error:
+                # The command exited while we were sending it input.
+                sent = 0
+                pending = b''
+                stdin = None
+            if not sent:
+                break
+            pending = pending[sent:]
+
+        if channel not in ready:
+            continue
+        while channel.recv_stderr_ready():
+            on_stderr(channel.recv_stderr(sshclient.RECV_BUFFER_SIZE))
+
+        try:
+            data = channel.recv(sshclient.RECV_BUFFER_SIZE)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        on_stdout(data)
+
+    channel.settimeout(None)
+    while True:
+        data = channel.recv_stderr(sshclient.RECV_BUFFER_SIZE)
+        if not data:
+            break
+        on_stderr(data)
+
+    return channel.recv_exit_status()
+
+
+async def discover(executor=None, all_addresses=False, target=None,
+                   timeout=None):
+    '''Returns a dict of device names to addresses found on the local network
+    segment. If all_addresses is set, each name maps to a list of every address
+    the device advertised instead. target and timeout are as for
+    Discoverer.discover.'''
+
+    loop = asyncio.get_event_loop()
+    browser = discoverer.Discoverer()
+    await loop.run_in_executor(executor, browser.discover, target, timeout)
+    if all_addresses:
+        return dict(browser.addresses)
+    return dict(browser.discoveries)
+
+
+class Device:
+    '''A single device. client_factory, if given, is called with no arguments
+    to create the SshClient-like object to use, which is how the CLI shares
+    multiplexed connections with this API.'''
+
+    def __init__(self, name, address, profile=None, executor=None,
+                 client_factory=None, log=None, addresses=None):
+        self.name = name
+        self.address = address
+        self.addresses = addresses
+        self.profile = profile
+        self.executor = executor
+        self.client_factory = client_factory
+        self.log = log
+        self.client = None
+        self.sftp = None
+        self.sftp_lock = threading.Lock()
+
+    def _call(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _threadsafe(self, callback):
+        if not callback:
+            return None
+        loop = asyncio.get_event_loop()
+        return lambda *args: loop.call_soon_threadsafe(callback, *args)
+
+    def _createClient(self):
+        if self.client_factory:
+            return self.client_factory()
+        return sshclient.SshClient(self.name, self.address, self.profile,
+                                   self.log, self.addresses)
+
+    async def connect(self, allowKeyPush=True):
+        if not self.client:
+            self.client = await self._call(self._createClient)
+        await self._call(self.client.connect, allowKeyPush)
+
+    def _exec(self, cmd, on_stdout, on_stderr):
+        channel = self.client.shellExec(cmd)
+        try:
+            return StreamChannel(channel, on_stdout, on_stderr)
+        finally:
+            channel.close()
+
+    async def exec(self, cmd, on_stdout=None, on_stderr=None):
+        '''Runs cmd on the device without a pty. Output is passed to on_stdout
+        and on_stderr, called from the event loop, as it arrives. If either is
+        omitted, that stream is collected and returned in the ExecResult.'''
+
+        if not self.client:
+            await self.connect()
+
+        stdout = []
+        stderr = []
+        status = await self._call(
+            self._exec, cmd,
+            self._threadsafe(on_stdout) or stdout.append,
+            self._threadsafe(on_stderr) or stderr.append)
+        return ExecResult(status, b''.join(stdout), b''.join(stderr))
+
+    def _openSftp(self):
+        # Every transfer shares one SFTP session, rather than paying for a
+        # new one per file.
+        with self.sftp_lock:
+            if not self.sftp:
+                self.sftp = self.client.openSftp()
+            return self.sftp
+
+    def _transfer(self, method, source, destination, callback):
+        getattr(self._openSftp(), method)(source, destination,
+                                          callback=callback)
+
+    async def put(self, localpath, remotepath, callback=None):
+        if not self.client:
+            await self.connect()
+        await self._call(self._transfer, 'put', localpath, remotepath,
+                         self._threadsafe(callback))
+
+    async def get(self, remotepath, localpath, callback=None):
+        if not self.client:
+            await self.connect()
+        await self._call(self._transfer, 'get', remotepath, localpath,
+                         self._threadsafe(callback))
+
+    def _close(self, client, sftp):
+        if sftp:
+            sftp.close()
+        client.close()
+
+    async def close(self):
+        if self.client:
+            client = self.client
+            sftp = self.sftp
+            self.client = None
+            self.sftp = None
+            await self._call(self._close, client, sftp)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+async def connect(name, address=None, profile=None, executor=None,
+                  allowKeyPush=True):
+    '''Connects to the device called name, discovering its address first if
+    one isn't given or set in its profile. name may also be an IP address, or
+    the serial number in a device profile.'''
+
+    addresses = None
+    if not address:
+        name = config.Config().resolveDevice(name)
+        address = config.Config().deviceProfile(name).get('address')
+
+    if not address:
+        if discoverer.IP_ADDR_REGEX.match(name):
+            address = name
+        else:
+            loop = asyncio.get_event_loop()
+            browser = discoverer.Discoverer()
+            found = await loop.run_in_executor(executor, browser.lookupCached,
+                                               name)
+            if not found:
+                await loop.run_in_executor(executor, browser.discover, name)
+            addresses = browser.addresses.get(name)
+            if not addresses:
+                raise discoverer.DeviceNotFoundError(name)
+            address = addresses[0]
+
+    device = Device(name, address, profile, executor, addresses=addresses)
+    await device.connect(allowKeyPush)
+    return device
@@ -15,7 +15,7 @@ limitations under the License.
 '''
 
 
-import re
+import asyncio
 import os
 import socket
 
@@ -23,21 +23,39 @@ from time import sleep
 
 from paramiko.ssh_exception import SSHException
 
+from mdt import api
 from mdt import config
 from mdt import console
 from mdt import discoverer
+from mdt import keys
+from mdt import multiplexer
+from mdt.options import OptionError, ParseOptions
 from mdt import sshclient
+from mdt import trace
 
 
-IP_ADDR_REGEX = re.compile('[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}')
+IP_ADDR_REGEX = discoverer.IP_ADDR_REGEX
 
 
 class NetworkCommand:
+    # Whether this command may share a connection held open by a multiplexer
+    # process. Commands that change the device's authorized keys should always
+    # use their own connection.
+    multiplexable = True
+
+    # The --options this command accepts before its other arguments, and
+    # whether each of them takes a value.
+    OPTIONS = {
+        '--profile': True,
+        '--trace': False,
+    }
+
     def __init__(self):
         self.config = config.Config()
         self.discoverer = discoverer.Discoverer(self)
         self.device = self.config.preferredDevice()
         self.address = None
+        self.options = {}
 
     def add_device(self, hostname, address):
         if not self.device:
@@ -47,6 +65,21 @@ class NetworkCommand:
             self.address = address
 
     def run(self, args):
+        try:
+            self.options, args = ParseOptions(args, self.OPTIONS)
+        except OptionError as e:
+            print(e)
+            return 1
+
+        if self.options.get('--trace') or trace.RequestedByEnvironment():
+            trace.Enable(command=args[0])
+
+        try:
+            return self._run(args)
+        finally:
+            trace.Report(device=self.device, address=self.address)
+
+    def _run(self, args):
         if not self.preConnectRun(args):
             return 1
 
@@ -55,12 +88,23 @@ class NetworkCommand:
         if self.device and IP_ADDR_REGEX.match(self.device):
             self.address = self.device
 
+        # Devices may also be named by the serial number in their profile,
+        # which may give their address too.
+        if self.device and not self.address:
+            self.device = self.config.resolveDevice(self.device)
+            self.address = self.config.deviceProfile(self.device).get('address')
+
+        if not self.address and self.device:
+            with trace.Phase('discovery-cache'):
+                self.discoverer.lookupCached(self.device)
+
         if not self.address:
             if self.device:
                 print('Waiting for device {0}...'.format(self.device))
             else:
                 print('Waiting for a device...')
-            self.discoverer.discover()
+            with trace.Phase('discovery'):
+                self.discoverer.discover(self.device or discoverer.AnyDevice)
 
         if not self.address:
             if not self.device:
@@ -72,8 +116,13 @@ class NetworkCommand:
         client = None
         try:
             print('Connecting to {0} at {1}'.format(self.device, self.address))
-            client = sshclient.SshClient(self.device, self.address)
-            return self.runWithClient(client, args)
+            with trace.Phase('client-setup'):
+                client = self.openClient()
+            with trace.Phase('command'):
+                return self.runWithClient(client, args)
+        except keys.KeystoreError as e:
+            print(e)
+            return 1
         except sshclient.KeyPushError as e:
             print("Unable to push keys to the device: {0}".format(e))
             return 1
@@ -112,6 +161,39 @@ class NetworkCommand:
             if client:
                 client.close()
 
+    def openClient(self, device=None, address=None):
+        if not device:
+            device = self.device
+            address = self.address
+
+        # Discovery may have found the device on several links; race them all.
+        addresses = self.discoverer.addresses.get(device)
+        if address not in (addresses or []):
+            addresses = None
+
+        if (self.multiplexable and multiplexer.IsSupported() and
+                self.config.shouldMultiplex() == "true"):
+            return multiplexer.MultiplexClient(device, address,
+                                               self.options.get('--profile'),
+                                               log=print, addresses=addresses)
+        return sshclient.SshClient(device, address,
+                                   self.options.get('--profile'), log=print,
+                                   addresses=addresses)
+
+    def runWithDevice(self, client, work):
+        '''Runs the coroutine returned by work(device) to completion, where
+        device is an api.Device that drives the already connected client.'''
+
+        device = api.Device(self.device, self.address,
+                            client_factory=lambda: client)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(work(device))
+        finally:
+            loop.run_until_complete(device.close())
+            loop.close()
+
     def runWithClient(self, client, args):
         return 1
 
@@ -15,52 +15,253 @@ limitations under the License.
 '''
 
 
+import contextlib
+import json
 import os
 import sys
+import tempfile
+import threading
 
 
 CONFIG_BASEDIR = os.path.join(os.path.expanduser("~"), ".config", "mdt")
+CONFIG_FILE = os.path.join(CONFIG_BASEDIR, "config.json")
+
+# Older versions of MDT stored each attribute in its own file in here. They're
+# copied into CONFIG_FILE the first time it's needed and doesn't exist yet.
 CONFIG_ATTRDIR = os.path.join(CONFIG_BASEDIR, "attribs")
 
 DEFAULT_USERNAME = "mendel"
 DEFAULT_PASSWORD = "mendel"
 DEFAULT_DISABLE_PASSWD_AUTH = "true"
 DEFAULT_ENV_WHITELIST = "TERM LANG LC_*"
+DEFAULT_KEY_TYPE = "rsa"
+DEFAULT_CONNECTION_PROFILE = "auto"
+DEFAULT_MULTIPLEX = "false"
+DEFAULT_MULTIPLEX_IDLE_TIMEOUT = "600"
+DEFAULT_DISCOVERY_CACHE_TTL = "300"
+DEFAULT_DISCOVERY_SERVICE = "false"
+
+# Fields a per-device profile may set. serial is only used to look profiles
+# up; the rest override the global settings of the same name.
+DEVICE_PROFILE_FIELDS = ('serial', 'address', 'port', 'username', 'password',
+                         'key', 'connection-profile')
+
+# The contents of CONFIG_FILE, loaded at most once per process, and the index
+# over its device profiles.
+_cache = None
+_index = None
+_cacheLock = threading.Lock()
+
+# Stands in for FileLock where flock isn't available.
+_fileLock = threading.RLock()
+
+
+def _migrateAttributes():
+    attributes = {}
+    if os.path.isdir(CONFIG_ATTRDIR):
+        for name in os.listdir(CONFIG_ATTRDIR):
+            with open(os.path.join(CONFIG_ATTRDIR, name), "r") as fp:
+                attributes[name] = fp.readline().rstrip()
+
+    return {"attributes": attributes, "devices": {}}, bool(attributes)
+
+
+def _migrateConnectionProfiles(data):
+    # Per-device connection profiles used to be set as variables called
+    # connection-profile.<device>. They now live in device profiles, which win
+    # if both are set.
+    prefix = "connection-profile."
+    names = [name for name in data["attributes"] if name.startswith(prefix)]
+    for name in names:
+        profile = data["devices"].setdefault(name[len(prefix):], {})
+        value = data["attributes"].pop(name)
+        profile.setdefault("connection-profile", value)
+    return bool(names)
+
+
+def _readConfigFile():
+    '''Returns the contents of CONFIG_FILE, and whether older settings were
+    migrated into them, in which case they should be written back.'''
+
+    if not os.path.exists(CONFIG_FILE):
+        data, migrated = _migrateAttributes()
+    else:
+        # A truncated or corrupt file is treated as empty, as the other
+        # caches do.
+        try:
+            with open(CONFIG_FILE, "r") as fp:
+                data = json.load(fp)
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        data.setdefault("attributes", {})
+        data.setdefault("devices", {})
+        migrated = False
+
+    migrated = _migrateConnectionProfiles(data) or migrated
+    return data, migrated
+
+
+def WriteFileAtomically(path, contents):
+    '''Replaces the file at path with contents by writing a temporary file
+    next to it and renaming that into place, so that a crash or a concurrent
+    mdt process never sees a half written file.'''
+
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=".{0}-".format(name),
+                                     dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(contents)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+@contextlib.contextmanager
+def FileLock(path):
+    '''Holds an exclusive lock on path + ".lock" for the duration, which
+    serializes read-modify-write cycles on path between threads and
+    processes. Where flock isn't available, only threads are serialized.'''
+
+    try:
+        import fcntl
+    except ImportError:
+        with _fileLock:
+            yield
+        return
+
+    with open(path + ".lock", "a") as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _writeConfigFile(data):
+    Config().ensureConfigDirExists()
+    WriteFileAtomically(CONFIG_FILE,
+                        json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+def _rewriteConfigFile(change):
+    # Re-read the file under its lock before changing it, so that we don't
+    # clobber changes made by other processes since we cached it.
+    Config().ensureConfigDirExists()
+    with FileLock(CONFIG_FILE):
+        data, migrated = _readConfigFile()
+        change(data)
+        _writeConfigFile(data)
+    return data
+
+
+def _load():
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            data, migrated = _readConfigFile()
+            if migrated:
+                data = _rewriteConfigFile(lambda data: None)
+            _cache = data
+        return _cache
+
+
+def _update(change):
+    global _cache, _index
+    with _cacheLock:
+        _cache = _rewriteConfigFile(change)
+        _index = None
+
+
+class DeviceProfileIndex:
+    '''Finds device profiles by device name or serial number in constant time,
+    however many devices are configured.'''
+
+    def __init__(self, profiles):
+        self.byName = profiles
+        self.bySerial = {}
+        for name, profile in profiles.items():
+            if profile.get("serial"):
+                self.bySerial[profile["serial"]] = name
+
+    def resolve(self, device):
+        if device in self.byName:
+            return device
+        return self.bySerial.get(device)
+
+    def lookup(self, device):
+        return self.byName.get(self.resolve(device), {})
+
+
+def _deviceProfiles():
+    global _index
+    data = _load()
+    with _cacheLock:
+        if _index is None:
+            _index = DeviceProfileIndex(data["devices"])
+        return _index
 
 
 class Config:
-    def __init__(self):
-        self.ensureConfigDirExists()
-
     def ensureConfigDirExists(self):
         if not os.path.exists(CONFIG_BASEDIR):
             os.makedirs(CONFIG_BASEDIR, mode=0o700)
-        if not os.path.exists(CONFIG_ATTRDIR):
-            os.makedirs(CONFIG_ATTRDIR, mode=0o700)
 
     def getAllAttributes(self):
-        vars = {}
-        for name in os.listdir(CONFIG_ATTRDIR):
-            vars[name] = self.getAttribute(name)
-        return vars
+        return dict(_load()["attributes"])
 
     def getAttribute(self, name, default=None):
-        path = os.path.join(CONFIG_ATTRDIR, name)
-        if os.path.exists(path):
-            with open(path, "r") as fp:
-                return fp.readline().rstrip()
-
-        return default
+        return _load()["attributes"].get(name, default)
 
     def setAttribute(self, name, value):
-        path = os.path.join(CONFIG_ATTRDIR, name)
-        with open(path, "w") as fp:
-            fp.write(value + "\n")
+        def change(data):
+            data["attributes"][name] = value
+        _update(change)
 
     def clearAttribute(self, name):
-        path = os.path.join(CONFIG_ATTRDIR, name)
-        if os.path.exists(path):
-            os.unlink(path)
+        if name not in _load()["attributes"]:
+            return
+
+        def change(data):
+            data["attributes"].pop(name, None)
+        _update(change)
+
+    def deviceProfile(self, device):
+        '''Returns the profile for device, given its name or serial number, as
+        a dict of field names to values. Empty if it has no profile.'''
+        if not device:
+            return {}
+        return dict(_deviceProfiles().lookup(device))
+
+    def resolveDevice(self, device):
+        '''Returns the name of the profile device refers to, by name or serial
+        number, or device itself if there is none.'''
+        return _deviceProfiles().resolve(device) or device
+
+    def getAllDeviceProfiles(self):
+        return dict((name, dict(profile))
+                    for name, profile in _load()["devices"].items())
+
+    def setDeviceProfileField(self, device, field, value):
+        def change(data):
+            data["devices"].setdefault(device, {})[field] = value
+        _update(change)
+
+    def clearDeviceProfileField(self, device, field=None):
+        def change(data):
+            if field is None:
+                data["devices"].pop(device, None)
+                return
+            profile = data["devices"].get(device, {})
+            profile.pop(field, None)
+            if not profile:
+                data["devices"].pop(device, None)
+        _update(change)
 
     def preferredDevice(self, devicename=None):
         if not devicename:
@@ -88,6 +289,47 @@ class Config:
                                      DEFAULT_DISABLE_PASSWD_AUTH)
         self.setAttribute("disable-password-auth", disablePasswdAuth)
 
+    def keyType(self, keytype=None):
+        if not keytype:
+            return self.getAttribute("key-type", DEFAULT_KEY_TYPE)
+        self.setAttribute("key-type", keytype)
+
+    def connectionProfile(self, device=None, profile=None):
+        if not profile:
+            if device:
+                return (self.deviceProfile(device).get("connection-profile") or
+                        self.connectionProfile())
+            return self.getAttribute("connection-profile",
+                                     DEFAULT_CONNECTION_PROFILE)
+        if device:
+            self.setDeviceProfileField(self.resolveDevice(device),
+                                       "connection-profile", profile)
+        else:
+            self.setAttribute("connection-profile", profile)
+
+    def shouldMultiplex(self, multiplex=None):
+        if multiplex == None:
+            return self.getAttribute("multiplex", DEFAULT_MULTIPLEX)
+        self.setAttribute("multiplex", multiplex)
+
+    def multiplexIdleTimeout(self, timeout=None):
+        if not timeout:
+            return self.getAttribute("multiplex-idle-timeout",
+                                     DEFAULT_MULTIPLEX_IDLE_TIMEOUT)
+        self.setAttribute("multiplex-idle-timeout", timeout)
+
+    def discoveryCacheTtl(self, ttl=None):
+        if not ttl:
+            return self.getAttribute("discovery-cache-ttl",
+                                     DEFAULT_DISCOVERY_CACHE_TTL)
+        self.setAttribute("discovery-cache-ttl", ttl)
+
+    def useDiscoveryService(self, enabled=None):
+        if enabled == None:
+            return self.getAttribute("discovery-service",
+                                     DEFAULT_DISCOVERY_SERVICE)
+        self.setAttribute("discovery-service", enabled)
+
 
 class GetCommand:
     '''Usage: mdt get [<variablename>]
@@ -105,6 +347,29 @@ nvariables are:
                           device with. Defaults to 'mendel'. Only used
                           during the initial setup phase of pushing an SSH
                           key to the board.
+    key-type            - the type of SSH key genkey generates: one of 'rsa',
+                          'ecdsa' or 'ed25519'. Defaults to 'rsa'.
+    connection-profile  - tunes compression, ciphers and window sizes for the
+                          link to the device: one of 'usb-fast', 'wifi',
+                          'slow-link' or 'auto'. Defaults to 'auto', which
+                          picks 'usb-fast' for devices connected via USB and
+                          'wifi' otherwise. Use 'mdt profile' to override
+                          this for a single device.
+    multiplex           - set this to 'true' to keep one authenticated SSH
+                          connection per device open in a background process
+                          and share it between mdt invocations. Defaults to
+                          'false'.
+    multiplex-idle-timeout
+                        - number of seconds a shared connection may sit idle
+                          before it is closed. Defaults to 600.
+    discovery-cache-ttl - number of seconds a device's discovered addresses
+                          are remembered for. While they are, commands try
+                          them before falling back to mDNS. Defaults to 300;
+                          set to 0 to always use mDNS.
+    discovery-service   - set this to 'true' to keep one mDNS browser running
+                          in a background process and have mdt invocations
+                          ask it for devices instead of browsing themselves.
+                          Defaults to 'false'.
 
 If no variable name is provided, 'mdt get' will print out the list of all
 known stored variables and their values. Note: default values are not printed.
@@ -147,6 +412,29 @@ Sets the value for a given variable name. Some useful variables are:
                           device with. Defaults to 'mendel'. Only used
                           during the initial setup phase of pushing an SSH
                           key to the board.
+    key-type            - the type of SSH key genkey generates: one of 'rsa',
+                          'ecdsa' or 'ed25519'. Defaults to 'rsa'.
+    connection-profile  - tunes compression, ciphers and window sizes for the
+                          link to the device: one of 'usb-fast', 'wifi',
+                          'slow-link' or 'auto'. Defaults to 'auto', which
+                          picks 'usb-fast' for devices connected via USB and
+                          'wifi' otherwise. Use 'mdt profile' to override
+                          this for a single device.
+    multiplex           - set this to 'true' to keep one authenticated SSH
+                          connection per device open in a background process
+                          and share it between mdt invocations. Defaults to
+                          'false'.
+    multiplex-idle-timeout
+                        - number of seconds a shared connection may sit idle
+                          before it is closed. Defaults to 600.
+    discovery-cache-ttl - number of seconds a device's discovered addresses
+                          are remembered for. While they are, commands try
+                          them before falling back to mDNS. Defaults to 300;
+                          set to 0 to always use mDNS.
+    discovery-service   - set this to 'true' to keep one mDNS browser running
+                          in a background process and have mdt invocations
+                          ask it for devices instead of browsing themselves.
+                          Defaults to 'false'.
 
 Note that setting a variable to the empty string does not clear it back to
 the default value! Use 'mdt clear' for that.
@@ -176,3 +464,89 @@ default value.
         if args:
             self.config.clearAttribute(args[1])
             print("Cleared {0}".format(args[1]))
+
+
+class ProfileCommand:
+    '''Usage: mdt profile [<device> [<field> [<value>]]]
+       mdt profile --clear <device> [<field>]
+
+Shows or changes per-device profiles, which override the global settings for a
+single device so that boards with different setups can be used side by side.
+<device> is the device's name, or the serial number stored in its profile.
+
+With no arguments, prints every profile. With just <device>, prints that
+device's profile, and with <field> as well, just that field. With a <value>,
+sets the field. --clear removes a field, or the whole profile.
+
+Fields are:
+
+    serial              - the device's serial number, so that it can be named
+                          by serial on the command line.
+    address             - the device's IP address. Skips discovery entirely.
+    port                - the port the device's SSH server listens on.
+                          Defaults to 22.
+    username            - overrides the username variable.
+    password            - overrides the password variable.
+    key                 - path to a private key to connect with instead of the
+                          MDT key.
+    connection-profile  - overrides the connection-profile variable.
+'''
+
+    def __init__(self):
+        self.config = Config()
+
+    def _printProfile(self, device, profile):
+        print(device)
+        for field in DEVICE_PROFILE_FIELDS:
+            if field in profile:
+                print("    {0:<20}{1}".format(field, profile[field]))
+
+    def run(self, args):
+        if len(args) > 1 and args[1] == "--clear":
+            if len(args) not in (3, 4):
+                print("Usage: mdt profile --clear <device> [<field>]")
+                return 1
+            device = self.config.resolveDevice(args[2])
+            field = args[3] if len(args) == 4 else None
+            self.config.clearDeviceProfileField(device, field)
+            print("Cleared {0}".format(
+                device if not field else "{0} for {1}".format(field, device)))
+            return 0
+
+        if len(args) > 2 and args[2] not in DEVICE_PROFILE_FIELDS:
+            print("Unknown field '{0}': must be one of {1}".format(
+                args[2], ", ".join(DEVICE_PROFILE_FIELDS)))
+            return 1
+
+        if len(args) == 1:
+            profiles = self.config.getAllDeviceProfiles()
+            if not profiles:
+                print("No device profiles are set.")
+            for device, profile in sorted(profiles.items()):
+                self._printProfile(device, profile)
+        elif len(args) == 2:
+            device = self.config.resolveDevice(args[1])
+            profile = self.config.deviceProfile(device)
+            if not profile:
+                print("{0} has no profile".format(device))
+                return 1
+            self._printProfile(device, profile)
+        elif len(args) == 3:
+            device = self.config.resolveDevice(args[1])
+            value = self.config.deviceProfile(device).get(args[2])
+            if value is None:
+                print("{0} is unset for {1}".format(args[2], device))
+            else:
+                print("{0} is {1} for {2}".format(args[2], value, device))
+        elif len(args) == 4:
+            if args[2] == "port" and not args[3].isdigit():
+                print("port must be a number")
+                return 1
+            device = self.config.resolveDevice(args[1])
+            self.config.setDeviceProfileField(device, args[2], args[3])
+            print("Set {0} to {1} for {2}".format(args[2], args[3], device))
+        else:
+            print("Usage: mdt profile [<device> [<field> [<value>]]]")
+            return 1
+
+        return 0
@@ -15,20 +15,35 @@ limitations under the License.
 '''
 
 
+import codecs
 import os
 import platform
 import queue
-import select
+import selectors
 import socket
 import sys
 import threading
+import time
+
+from mdt import sshclient
 
 
 TYPE_KEYBOARD_INPUT = 0
 TYPE_TERMINAL_OUTPUT = 1
 TYPE_REMOTE_CLOSED = 2
 TYPE_SOCKET_TIMEOUT = 3
-KEEP_ALIVE_SECONDS = 10
+INPUT_BUFFER_SIZE = 16384
+
+# Output is held for up to OUTPUT_FLUSH_SECONDS, or until OUTPUT_FLUSH_SIZE bytes
+# have built up, so that bulk output isn't flushed to the terminal one packet
+# at a time.
+OUTPUT_FLUSH_SECONDS = 0.01
+OUTPUT_FLUSH_SIZE = 65536
+
+# How much may be buffered in each direction before we stop reading from the
+# other end, so that a slow terminal or a full remote window pushes back.
+OUTPUT_BUFFER_LIMIT = 262144
+INPUT_BUFFER_LIMIT = 65536
 
 
 class ConnectionClosedError(Exception):
@@ -48,6 +63,34 @@ def GetTtyWindowSize(fd):
     return struct.unpack('hh', tty_size)
 
 
+def FilterEscapes(data, escape_level):
+    '''Looks for the \\r~. escape sequence in a chunk of keyboard input, which
+    may have been split across several chunks. escape_level is how much of the
+    sequence the previous chunk ended with.
+
+    The ~ is held back until we know whether a . follows it. As in OpenSSH,
+    \\r~~ sends a single ~. Returns a tuple of (data_to_send, escape_level,
+    escaped).'''
+
+    output = bytearray()
+    for byte in data:
+        if escape_level == 1 and byte == ord('~'):
+            escape_level = 2
+            continue
+        if escape_level == 2:
+            if byte == ord('.'):
+                return bytes(output), 0, True
+            output += b'~'
+            if byte == ord('~'):
+                escape_level = 0
+                continue
+
+        output.append(byte)
+        escape_level = 1 if byte == ord('\r') else 0
+
+    return bytes(output), escape_level, False
+
+
 class PosixConsole:
     def __init__(self, channel, inputfile):
         self.channel = channel
@@ -75,6 +118,40 @@ class PosixConsole:
 
         return sock.getsockopt(socket.SOL_SOCKET, SO_NWRITE)
 
+    def _watch(self, selector, fileobj, events):
+        try:
+            key = selector.get_key(fileobj)
+        except KeyError:
+            key = None
+
+        if key and not events:
+            selector.unregister(fileobj)
+        elif key and key.events != events:
+            selector.modify(fileobj, events)
+        elif not key and events:
+            selector.register(fileobj, events)
+
+    def _writeOutput(self, fd, output):
+        '''Writes as much of output to fd as it takes without blocking, and
+        removes that from output.'''
+
+        while output:
+            try:
+                written = os.write(fd, output)
+            except BlockingIOError:
+                return
+            del output[:written]
+
+    def _sendInput(self, pending):
+        '''Sends as much of pending as the remote window has room for, and
+        removes that from pending.'''
+
+        while pending and self.channel.send_ready():
+            try:
+                sent = self.channel.send(bytes(pending))
+            except socket.timeout:
+                return
+            del pending[:sent]
 
     def run(self):
         import termios
@@ -110,19 +187,62 @@ class PosixConsole:
         except termios.error as e:
             self.has_tty = False
 
+        # Output is passed through to the terminal as raw bytes, without
+        # blocking, so that a slow terminal can't stop us servicing the
+        # channel.
+        sys.stdout.flush()
+        stdout_fd = sys.stdout.fileno()
+        stdout_blocking = os.get_blocking(stdout_fd)
+        output = bytearray()
+        flush_deadline = None
+        pending = bytearray()
+        selector = selectors.DefaultSelector()
+
+        # Input that can't be polled, like a regular file, is ignored.
+        input_open = True
+        try:
+            selector.register(self.inputfile, selectors.EVENT_READ)
+        except (OSError, ValueError):
+            input_open = False
+
         try:
             self.channel.settimeout(0)
-            self.channel.get_transport().set_keepalive(KEEP_ALIVE_SECONDS)
+            self.channel.get_transport().set_keepalive(sshclient.KEEP_ALIVE_SECS)
+            os.set_blocking(stdout_fd, False)
             timeout_count = 0
             initial_tx_level = 0
 
             while True:
-                read, write, exception = select.select([self.channel,
-                                                        self.inputfile],
-                                                       [], [], KEEP_ALIVE_SECONDS + 1)
-
-                select_timedout = not read and not write and not exception
-                if select_timedout:
+                output_due = output and (len(output) >= OUTPUT_FLUSH_SIZE or
+                                         time.time() >= flush_deadline)
+                if output_due:
+                    self._writeOutput(stdout_fd, output)
+                    if not output:
+                        flush_deadline = None
+                if pending:
+                    self._sendInput(pending)
+
+                self._watch(selector, self.channel,
+                            selectors.EVENT_READ
+                            if len(output) < OUTPUT_BUFFER_LIMIT else 0)
+                self._watch(selector, self.inputfile,
+                            selectors.EVENT_READ
+                            if input_open and len(pending) < INPUT_BUFFER_LIMIT
+                            else 0)
+                self._watch(selector, stdout_fd,
+                            selectors.EVENT_WRITE
+                            if output_due and output else 0)
+
+                timeout = sshclient.KEEP_ALIVE_SECS + 1
+                if output and not output_due:
+                    timeout = max(0, flush_deadline - time.time())
+                if pending:
+                    timeout = min(timeout, sshclient.SEND_RETRY_SECS)
+
+                events = selector.select(timeout)
+                ready = set(key.fileobj for key, mask in events)
+
+                if not events and not output and not pending:
                     timeout_count += 1
 
                     if timeout_count == 1:
@@ -131,37 +251,33 @@ class PosixConsole:
                         current_tx_level = self._socketSendQueueLevel()
                         if current_tx_level and current_tx_level >= initial_tx_level:
                             raise SocketTimeoutError(socket.timeout())
-                else:
+                elif events:
                     timeout_count = 0
 
                 # data from device to host
-                if self.channel in read:
+                if self.channel in ready:
                     try:
-                        data = self.channel.recv(256)
+                        data = self.channel.recv(min(
+                            sshclient.RECV_BUFFER_SIZE,
+                            OUTPUT_BUFFER_LIMIT - len(output)))
                         if not data:
                             exit_code = None
                             if self.channel.exit_status_ready():
                                 exit_code = self.channel.recv_exit_status()
                             raise ConnectionClosedError(exit_code=exit_code)
-                        sys.stdout.write(data.decode("utf-8", errors="ignore"))
-                        sys.stdout.flush()
+                        if not output:
+                            flush_deadline = time.time() + OUTPUT_FLUSH_SECONDS
+                        output += data
                     except socket.timeout as e:
                         raise SocketTimeoutError(e)
 
                 # data from host to device
-                if self.inputfile in read:
+                if self.inputfile in ready:
                     fd = self.inputfile.fileno()
-                    data = os.read(fd, 1)
-
-                    if escape_level == 0 and data == b'\r':
-                        escape_level += 1
-                    elif escape_level == 1 and data == b'~':
-                        escape_level += 1
+                    try:
+                        data = os.read(fd, INPUT_BUFFER_SIZE)
+                    except BlockingIOError:
                         continue
-                    elif escape_level == 2 and data == b'.':
-                        raise ConnectionClosedError(exit_code=0)
-                    else:
-                        escape_level = 0
 
                     if not data:
                         exit_code = None
@@ -169,8 +285,17 @@ class PosixConsole:
                             exit_code = self.channel.recv_exit_status()
                         raise ConnectionClosedError(exit_code=exit_code)
 
-                    self.channel.send(data)
+                    data, escape_level, escaped = FilterEscapes(data,
+                                                                escape_level)
+                    if escaped:
+                        raise ConnectionClosedError(exit_code=0)
+                    pending += data
         finally:
+            selector.close()
+            os.set_blocking(stdout_fd, stdout_blocking)
+            if output:
+                sys.stdout.buffer.write(output)
+                sys.stdout.flush()
             if self.has_tty:
                 termios.tcsetattr(self.inputfile, TCSADRAIN, old_tty_attrs)
 
@@ -195,17 +320,19 @@ class TerminalOutputThread(threading.Thread):
         self.channel = channel
 
     def run(self):
+        # The Windows console takes text, so decode incrementally to keep
+        # characters split across reads intact.
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
         while True:
             try:
-                data = self.channel.recv(256)
+                data = self.channel.recv(sshclient.RECV_BUFFER_SIZE)
                 if not data:
                     exit_code = None
                     if self.channel.exit_status_ready():
                         exit_code = self.channel.recv_exit_status()
                     self.queue.put((TYPE_REMOTE_CLOSED, exit_code))
                     break
-                data = data.decode("utf-8", errors="ignore")
-                self.queue.put((TYPE_TERMINAL_OUTPUT, data))
+                self.queue.put((TYPE_TERMINAL_OUTPUT, decoder.decode(data)))
             except socket.timeout:
                 self.queue.put((TYPE_SOCKET_TIMEOUT, None))
                 break
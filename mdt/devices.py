@@ -15,18 +15,30 @@ limitations under the License.
 '''
 
 
-from time import sleep
+import fnmatch
+import json
+import time
 
+from mdt.options import OptionError, ParseOptions
 from mdt.discoverer import Discoverer
 from mdt.config import Config
 
 
 class DevicesCommand:
-    '''Usage: mdt devices
+    '''Usage: mdt devices [--json|--ndjson] [--watch]
 
 Returns a list of device names and IP addresses found on the local network
 segment. Also indicates if a given device is marked as your default.
 
+With --json, prints the devices found as a JSON array once discovery is done.
+With --ndjson, prints each device as a line of JSON as soon as it's resolved.
+Either way, each device includes all of its addresses, the TXT record metadata
+it advertises, and how long it took to resolve after it was first heard.
+
+With --watch, keeps browsing until interrupted, and prints an event each time a
+device appears, changes or disappears. Events are lines of JSON if --json or
+--ndjson is also given, and plain text otherwise.
+
 Variables used:
    preferred-device: contains the device name you want as your default.
                      Can be set to an IPv4 address to bypass the mDNS lookup.
@@ -35,13 +47,91 @@ Note: MDT uses a python implementation of mDNS ZeroConf for discovery, so
 it does not require a running Avahi daemon.
 '''
 
+    OPTIONS = {
+        '--json': False,
+        '--ndjson': False,
+        '--watch': False,
+    }
+
     def __init__(self):
-        self.discoverer = Discoverer()
+        self.discoverer = Discoverer(self)
         self.device = Config().preferredDevice()
+        self.options = {}
+        self.streaming = False
+        self.seen = {}
+
+    def _deviceRecord(self, hostname):
+        latency = self.discoverer.latencies.get(hostname)
+        if latency is not None:
+            latency = round(latency * 1000, 1)
+
+        return {
+            'name': hostname,
+            'address': self.discoverer.discoveries[hostname],
+            'addresses': self.discoverer.addresses[hostname],
+            'default': hostname == self.device,
+            'properties': self.discoverer.properties.get(hostname, {}),
+            'latency_ms': latency,
+        }
+
+    def _emit(self, event, record):
+        if '--json' in self.options or '--ndjson' in self.options:
+            record = dict(record, event=event)
+            print(json.dumps(record, sort_keys=True), flush=True)
+        else:
+            marker = {'add': '+', 'update': '*', 'remove': '-'}[event]
+            print('{0} {1}\t\t({2})'.format(marker, record['name'],
+                                            record['address']), flush=True)
+
+    def add_device(self, hostname, address):
+        if not self.streaming:
+            return
+
+        record = self._deviceRecord(hostname)
+        if self.seen.get(hostname) == record:
+            return
+
+        event = 'update' if hostname in self.seen else 'add'
+        self.seen[hostname] = record
+        self._emit(event, record)
+
+    def remove_device(self, hostname, address):
+        if self.streaming and hostname in self.seen:
+            del self.seen[hostname]
+            self._emit('remove', {'name': hostname, 'address': address})
 
     def run(self, args):
+        try:
+            self.options, args = ParseOptions(args, self.OPTIONS)
+        except OptionError as e:
+            print(e)
+            return 1
+
+        if len(args) > 1:
+            print('Usage: mdt devices [--json|--ndjson] [--watch]')
+            return 1
+
+        if '--watch' in self.options:
+            self.streaming = True
+            try:
+                self.discoverer.watch()
+            except KeyboardInterrupt:
+                pass
+            return 0
+
+        if '--ndjson' in self.options:
+            self.streaming = True
+            self.discoverer.discover()
+            return 0
+
         self.discoverer.discover()
         discoveries = self.discoverer.discoveries
+
+        if '--json' in self.options:
+            records = [self._deviceRecord(host) for host in sorted(discoveries)]
+            print(json.dumps(records, indent=2, sort_keys=True))
+            return 0
+
         for host, address in discoveries.items():
             if self.device and host == self.device:
                 print('{0}\t\t({1},default)'.format(host, address))
@@ -50,25 +140,75 @@ it does not require a running Avahi daemon.
 
 
 class DevicesWaitCommand:
-    '''Usage: mdt wait-for-device
+    '''Usage: mdt wait-for-device [--count <n>] [--name <pattern>] [--timeout <secs>]
+
+Waits until a device is found, and prints how long it took to appear.
 
-Waits until a device is found.
+With --count, waits until <n> devices have been found instead. With --name,
+only counts devices whose names match the shell-style wildcard <pattern> (eg:
+'ci-board-*'). With --timeout, gives up and exits with an error if that many
+seconds pass first; otherwise waits forever.
 '''
 
+    OPTIONS = {
+        '--count': True,
+        '--name': True,
+        '--timeout': True,
+    }
+
     def __init__(self):
-        self.found_devices = False
         self.discoverer = Discoverer(self)
+        self.count = 1
+        self.pattern = '*'
+        self.start = 0
+        self.found = {}
 
     def add_device(self, hostname, address):
-        self.found_devices = True
-        self.hostname = hostname
-        self.address = address
+        if (len(self.found) >= self.count or hostname in self.found or
+                not fnmatch.fnmatch(hostname, self.pattern)):
+            return
 
-    def run(self, args):
-        print('Waiting for device...')
+        self.found[hostname] = address
+        print('Found {0} at {1} after {2:.2f}s'.format(
+            hostname, address, time.time() - self.start), flush=True)
 
-        while not self.found_devices:
-            self.discoverer.discover()
+        if len(self.found) >= self.count:
+            self.discoverer.stop()
 
-        print('Found {0} devices.'.format(len(self.discoverer.discoveries)))
+    def run(self, args):
+        try:
+            options, args = ParseOptions(args, self.OPTIONS)
+            self.count = int(options.get('--count', 1))
+            timeout = options.get('--timeout')
+            if timeout is not None:
+                timeout = float(timeout)
+        except OptionError as e:
+            print(e)
+            return 1
+        except ValueError:
+            print('--count and --timeout must be numbers')
+            return 1
+
+        if len(args) > 1 or self.count < 1:
+            print('Usage: mdt wait-for-device [--count <n>] [--name <pattern>] '
+                  '[--timeout <secs>]')
+            return 1
+
+        self.pattern = options.get('--name', '*')
+
+        if self.count == 1:
+            print('Waiting for device...')
+        else:
+            print('Waiting for {0} devices...'.format(self.count))
+
+        self.start = time.time()
+        self.discoverer.watch(timeout)
+
+        if len(self.found) < self.count:
+            print('Timed out after {0:.2f}s with {1} of {2} devices '
+                  'found.'.format(time.time() - self.start, len(self.found),
+                                  self.count))
+            return 1
+
+        print('Found {0} devices.'.format(len(self.found)))
         return 0
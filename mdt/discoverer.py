@@ -16,16 +16,307 @@ limitations under the License.
 
 
 from typing import cast
-from zeroconf import ServiceBrowser, Zeroconf
 
+import json
+import os
+import re
 import socket
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+from mdt import config
+from mdt import unixsocket
+
+
+IP_ADDR_REGEX = re.compile('[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}')
+DISCOVERY_CACHE_PATH = os.path.join(config.CONFIG_BASEDIR, "discovery-cache")
+DISCOVERY_SOCKET_PATH = os.path.join(config.CONFIG_BASEDIR, "discovery.sock")
+DISCOVERY_SERVICE_NAME = "discovery service"
+SERVICE_STARTUP_TIMEOUT_SECS = 5
+SERVICE_REPLY_GRACE_SECS = 2
+SSH_PORT = 22
+KEYMASTER_PORT = 41337
+PROBE_TIMEOUT_SECS = 0.08
+
+# Boards attached over USB sit on a point to point gadget network, at
+# USB_DEVICE_ADDRESS by default. When this machine has an address on that
+# subnet, targeted discovery also probes it directly, since mDNS is often slow
+# or filtered on locked-down hosts.
+USB_SUBNET_PREFIX = '192.168.100.'
+USB_DEVICE_ADDRESS = '192.168.100.2'
+USB_PROBE_TIMEOUT_SECS = 0.25
+USB_PROBE_WORKERS = 64
+HOST_KEY_PROBE_TIMEOUT_SECS = 2
+
+# Service info is resolved on a pool of this many threads, each lookup giving
+# up after RESOLVE_TIMEOUT_MS, so that a burst of announcements from a large
+# fleet resolves in parallel rather than one device at a time.
+RESOLVE_WORKERS = 16
+RESOLVE_TIMEOUT_MS = 3000
+
 
 class DeviceNotFoundError(Exception):
     pass
 
 
+class DiscoveryServiceError(Exception):
+    pass
+
+
+def ServiceProperties(info):
+    '''Returns the TXT record metadata of a zeroconf ServiceInfo as a dict of
+    strings.'''
+    properties = {}
+    for key, value in (info.properties or {}).items():
+        if isinstance(key, bytes):
+            key = key.decode('utf-8', 'replace')
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        properties[key] = value
+    return properties
+
+
+def ServiceAddresses(info):
+    '''Returns every address a zeroconf ServiceInfo advertises, IPv4 first.'''
+    if hasattr(info, 'parsed_addresses'):
+        addresses = info.parsed_addresses()
+    else:
+        addresses = [socket.inet_ntoa(cast(bytes, info.address))]
+    return sorted(addresses, key=lambda address: ':' in address)
+
+
+def ProbeAddress(address, port=SSH_PORT, timeout=PROBE_TIMEOUT_SECS):
+    '''Returns True if something accepts TCP connections on address:port.'''
+    try:
+        sock = socket.create_connection((address, port), timeout)
+    except socket.error:
+        return False
+    sock.close()
+    return True
+
+
+def LocalUsbAddress():
+    '''Returns this machine's address on the USB gadget subnet, or None if it
+    doesn't have one. Connecting a UDP socket only consults the routing table;
+    nothing is sent.'''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((USB_DEVICE_ADDRESS, SSH_PORT))
+        address = sock.getsockname()[0]
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+    if not address.startswith(USB_SUBNET_PREFIX):
+        return None
+    return address
+
+
+def ProbeUsbDevices(callback, cancelled, port=SSH_PORT):
+    '''Probes every other address on the USB gadget subnet, USB_DEVICE_ADDRESS
+    first, for anything answering on the SSH port given or the keymaster port.
+    Calls callback with each address that does, until the cancelled event is
+    set.'''
+
+    local = LocalUsbAddress()
+    if not local:
+        return
+
+    candidates = ['{0}{1}'.format(USB_SUBNET_PREFIX, host)
+                  for host in range(1, 255)]
+    candidates = sorted([address for address in candidates if address != local],
+                        key=lambda address: address != USB_DEVICE_ADDRESS)
+
+    def probe(address):
+        if cancelled.is_set():
+            return
+        if (ProbeAddress(address, port, USB_PROBE_TIMEOUT_SECS) or
+                ProbeAddress(address, KEYMASTER_PORT, USB_PROBE_TIMEOUT_SECS)):
+            if not cancelled.is_set():
+                callback(address)
+
+    with ThreadPoolExecutor(max_workers=USB_PROBE_WORKERS) as executor:
+        for address in candidates:
+            if cancelled.is_set():
+                break
+            executor.submit(probe, address)
+
+
+def IdentifyUsbDevice(address):
+    '''Returns the name of the device last discovered at address, if that's
+    still the device there, or None. Boards on the USB link get swapped, so the
+    name is only trusted if the device presents the same host key it did when
+    it last accepted the MDT key.'''
+
+    hostname = DiscoveryCache().hostnameFor(address)
+    if not hostname:
+        return None
+
+    # Imported here so that discovery only loads paramiko when it has to.
+    import paramiko
+    from mdt import keys
+
+    try:
+        sock = socket.create_connection((address, DeviceSshPort(hostname)),
+                                        HOST_KEY_PROBE_TIMEOUT_SECS)
+    except socket.error:
+        return None
+
+    transport = paramiko.Transport(sock)
+    try:
+        transport.start_client(timeout=HOST_KEY_PROBE_TIMEOUT_SECS)
+        fingerprint = keys.HostKeyFingerprint(transport.get_remote_server_key())
+    except (paramiko.SSHException, socket.error, EOFError):
+        return None
+    finally:
+        transport.close()
+
+    if not keys.AuthStateCache().isKnownGood(hostname, fingerprint):
+        return None
+    return hostname
+
+
+class ServiceResolver:
+    '''Resolves zeroconf services on a bounded pool of worker threads, and
+    passes each (name, info) pair that resolves to callback. Browser callbacks
+    run one at a time, so resolving from them directly would serialize every
+    lookup behind the slowest device.'''
+
+    def __init__(self, zeroconf, callback, workers=None):
+        self.zeroconf = zeroconf
+        self.callback = callback
+        self.executor = ThreadPoolExecutor(max_workers=workers or
+                                           RESOLVE_WORKERS)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def _resolve(self, type, name):
+        try:
+            info = self.zeroconf.get_service_info(type, name,
+                                                  RESOLVE_TIMEOUT_MS)
+            if info:
+                self.callback(name, info)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def resolve(self, type, name):
+        with self.lock:
+            self.pending += 1
+        self.executor.submit(self._resolve, type, name)
+
+    def busy(self):
+        with self.lock:
+            return self.pending > 0
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def QueryDiscoveryService(target, timeout):
+    '''Asks the shared discovery service, starting it if it isn't running,
+    for the devices it knows about. target is a device name to wait for, '*' to
+    wait for any device, or None to wait until announcements settle. Returns a
+    dict of hostnames to (addresses, properties) pairs.'''
+
+    try:
+        sock = unixsocket.Connect(DISCOVERY_SOCKET_PATH)
+    except socket.error:
+        try:
+            sock = unixsocket.Spawn(DISCOVERY_SOCKET_PATH,
+                                    DISCOVERY_SERVICE_NAME,
+                                    ['mdt.discoveryservice'],
+                                    SERVICE_STARTUP_TIMEOUT_SECS)
+        except unixsocket.ServerError as e:
+            raise DiscoveryServiceError(e)
+
+    try:
+        sock.settimeout(timeout + SERVICE_REPLY_GRACE_SECS)
+        request = {'target': target, 'timeout': timeout}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as fp:
+            reply = json.loads(fp.readline().decode('utf-8'))
+        return reply['devices']
+    except (socket.error, ValueError, KeyError) as e:
+        raise DiscoveryServiceError(e)
+    finally:
+        sock.close()
+
+
+class DiscoveryCache:
+    '''Remembers the addresses devices were last discovered at, so that later
+    runs can skip mDNS while the entries are younger than the
+    discovery-cache-ttl.'''
+
+    def __init__(self):
+        self.ttl = int(config.Config().discoveryCacheTtl())
+        self.entries = self._read()
+
+    def _read(self):
+        entries = {}
+        if os.path.exists(DISCOVERY_CACHE_PATH):
+            with open(DISCOVERY_CACHE_PATH, "r") as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        entries[fields[0]] = (float(fields[1]),
+                                              fields[2].split(','))
+        return entries
+
+    def _save(self, discoveries, now):
+        config.Config().ensureConfigDirExists()
+        with config.FileLock(DISCOVERY_CACHE_PATH):
+            self.entries = self._read()
+            for hostname, addresses in discoveries.items():
+                self.entries[hostname] = (now, addresses)
+            config.WriteFileAtomically(DISCOVERY_CACHE_PATH, "".join(
+                "{0} {1} {2}\n".format(hostname, timestamp, ','.join(addresses))
+                for hostname, (timestamp, addresses)
+                in sorted(self.entries.items())))
+
+    def lookup(self, hostname):
+        if hostname not in self.entries:
+            return []
+        timestamp, addresses = self.entries[hostname]
+        if time.time() - timestamp > self.ttl:
+            return []
+        return addresses
+
+    def hostnameFor(self, address):
+        '''Returns the name of the device most recently seen at address, however
+        long ago that was, or None.'''
+        seen = [(timestamp, hostname)
+                for hostname, (timestamp, addresses) in self.entries.items()
+                if address in addresses]
+        if not seen:
+            return None
+        return max(seen)[1]
+
+    def update(self, discoveries):
+        # Devices found by probing are named by their address, which isn't
+        # worth remembering.
+        discoveries = dict((hostname, addresses)
+                           for hostname, addresses in discoveries.items()
+                           if not IP_ADDR_REGEX.match(hostname))
+        if not discoveries or self.ttl <= 0:
+            return
+        self._save(discoveries, time.time())
+
+
+def DeviceSshPort(hostname):
+    '''Returns the SSH port set in hostname's device profile, or SSH_PORT.'''
+    return int(config.Config().deviceProfile(hostname).get('port', SSH_PORT))
+
+
+def AnyDevice(hostname):
+    '''Discovery target that matches the first device found.'''
+    return True
+
+
 class Discoverer:
     ANNOUNCE_PERIOD_SECS = 1
     MAXIMUM_WAIT_CYCLES = 10
@@ -33,49 +324,207 @@ class Discoverer:
 
     def __init__(self, listener=None):
         self.discoveries = {}
+        self.addresses = {}
+        self.properties = {}
+        self.latencies = {}
+        self.hostnames = {}
+        self.announced = {}
+        self.probed = set()
         self.listener = listener
         self.zeroconf = None
+        self.resolver = None
+        self.target = None
+        self.lock = threading.Lock()
+        self._found = threading.Event()
+        self._stop = threading.Event()
+
+    def discover(self, target=None, timeout=None):
+        '''Browses for devices. target may be a device name, or a predicate
+        called with each hostname as it's found; if given, discovery stops as
+        soon as a device matches it. Either way, gives up once announcements
+        stop for ANNOUNCE_PERIOD_SECS or after timeout seconds, which defaults
+        to MAXIMUM_WAIT_CYCLES announce periods.
+
+        Returns True if a device matched target.'''
+
+        if timeout is None:
+            timeout = (Discoverer.MAXIMUM_WAIT_CYCLES *
+                       Discoverer.ANNOUNCE_PERIOD_SECS)
+
+        query = None
+        port = SSH_PORT
+        if isinstance(target, str):
+            query = name = target
+            port = DeviceSshPort(name)
+            target = lambda hostname: hostname == name
+        elif target is AnyDevice:
+            query = '*'
+        self.target = target
+        self._found.clear()
+
+        if (config.Config().useDiscoveryService() == "true" and
+                hasattr(socket, 'AF_UNIX')):
+            try:
+                devices = QueryDiscoveryService(query, timeout)
+            except DiscoveryServiceError:
+                pass
+            else:
+                for hostname, (addresses, properties) in sorted(devices.items()):
+                    self._addDevice(hostname, addresses, properties)
+                self.target = None
+                return self._found.is_set()
 
-    def discover(self):
-        self.zeroconf = Zeroconf()
-        self.browser = ServiceBrowser(self.zeroconf, Discoverer.SERVICE_TYPE, self)
         self._heard_announcement = True
-        cycle_count = 0
+        deadline = time.time() + timeout
+        self._startBrowsing()
+
+        # Probing the USB link can only tell us who's there if we're after any
+        # device, or recognize the device at an address from an earlier
+        # discovery, so there's no point in it for a full scan.
+        probe_cancelled = threading.Event()
+        if target:
+            thread = threading.Thread(target=ProbeUsbDevices,
+                                      args=(self._usbDeviceFound,
+                                            probe_cancelled, port))
+            thread.daemon = True
+            thread.start()
 
-        # Keep waiting until we stop hearing announcements for a full second, or until we've waited 10 seconds
-        while self._heard_announcement and cycle_count < Discoverer.MAXIMUM_WAIT_CYCLES:
-            cycle_count += 1
+        # Keep waiting until we stop hearing announcements for a full second
+        # and have resolved everything we heard, the target turns up, or we
+        # run out of time.
+        while ((self._heard_announcement or self.resolver.busy()) and
+               not self._found.is_set()):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
             self._heard_announcement = False
-            time.sleep(Discoverer.ANNOUNCE_PERIOD_SECS)
+            self._found.wait(min(Discoverer.ANNOUNCE_PERIOD_SECS, remaining))
+
+        probe_cancelled.set()
+        self._stopBrowsing()
+        self.target = None
+        return self._found.is_set()
+
+    def watch(self, timeout=None):
+        '''Browses until stop() is called, or for timeout seconds if given,
+        passing devices to the listener as they come and go.'''
+
+        self._stop.clear()
+        self._startBrowsing()
+        try:
+            self._stop.wait(timeout)
+        finally:
+            self._stopBrowsing()
 
+    def stop(self):
+        self._stop.set()
+
+    def _startBrowsing(self):
+        # Imported here so that commands given a device's address don't pay for
+        # loading zeroconf.
+        from zeroconf import ServiceBrowser, Zeroconf
+
+        self.zeroconf = Zeroconf()
+        self.resolver = ServiceResolver(self.zeroconf, self._serviceResolved)
+        self.browser = ServiceBrowser(self.zeroconf, Discoverer.SERVICE_TYPE, self)
+
+    def _stopBrowsing(self):
         self.browser.cancel()
         self.browser = None
+        self.resolver.close()
+        self.resolver = None
+        self.zeroconf.close()
         self.zeroconf = None
 
-    def add_service(self, zeroconf, type, name):
-        info = self.zeroconf.get_service_info(type, name)
+        # Devices found by probing were only recognized from the cache, so
+        # they mustn't keep their own entries fresh.
+        DiscoveryCache().update(dict(
+            (hostname, addresses)
+            for hostname, addresses in self.addresses.items()
+            if hostname not in self.probed))
 
-        if info:
-            hostname = info.server.split('.')[0]
-            address = socket.inet_ntoa(cast(bytes, info.address))
+    def lookupCached(self, hostname):
+        '''Looks hostname up in the discovery cache, keeping only the addresses
+        that still answer on the SSH port in its device profile. Returns True,
+        and records the device as if it had been discovered, if any of them
+        do.'''
 
-            # Prevent duplicate announcements from extending the discovery delay
-            if hostname not in self.discoveries:
-                self._heard_announcement = True
+        port = DeviceSshPort(hostname)
+        addresses = [address for address in DiscoveryCache().lookup(hostname)
+                     if ProbeAddress(address, port)]
+        if not addresses:
+            return False
+
+        self._addDevice(hostname, addresses)
+        return True
 
+    def _addDevice(self, hostname, addresses, properties=None, latency=None):
+        with self.lock:
+            address = addresses[0]
             self.discoveries[hostname] = address
+            self.addresses[hostname] = addresses
+            self.properties[hostname] = properties or {}
+            if latency is not None:
+                self.latencies[hostname] = latency
 
             if self.listener and hasattr(self.listener, "add_device"):
                 self.listener.add_device(hostname, address)
 
-    def remove_service(self, zeroconf, type, name):
-        info = self.zeroconf.get_service_info(type, name)
+            if self.target and self.target(hostname):
+                self._found.set()
+
+    def _usbDeviceFound(self, address):
+        hostname = IdentifyUsbDevice(address)
+        if not hostname:
+            if self.target is not AnyDevice:
+                return
+            hostname = address
 
-        if info:
-            if self.listener and hasattr(self.listener, "remove_device"):
-                self.listener.remove_device(info.server,
-                                            self.discoveries[info.server])
+        with self.lock:
+            if hostname in self.discoveries:
+                return
+            self.probed.add(hostname)
+        self._addDevice(hostname, [address])
 
-            if info.server in self.discoveries:
+    def _serviceResolved(self, name, info):
+        addresses = ServiceAddresses(info)
+        if addresses:
+            hostname = info.server.split('.')[0]
+            self.hostnames[name] = hostname
+            self.probed.discard(hostname)
+
+            # Latency runs from when we first heard of the service until it
+            # first resolved; later updates don't count.
+            latency = None
+            announced = self.announced.pop(name, None)
+            if announced:
+                latency = time.time() - announced
+
+            self._addDevice(hostname, addresses, ServiceProperties(info),
+                            latency)
+
+    def add_service(self, zeroconf, type, name):
+        # Prevent duplicate announcements from extending the discovery delay
+        if name not in self.hostnames:
+            self._heard_announcement = True
+            self.hostnames[name] = None
+            self.announced[name] = time.time()
+
+        self.resolver.resolve(type, name)
+
+    def update_service(self, zeroconf, type, name):
+        self.resolver.resolve(type, name)
+
+    def remove_service(self, zeroconf, type, name):
+        hostname = self.hostnames.pop(name, None)
+
+        with self.lock:
+            if hostname in self.discoveries:
                 self._heard_announcement = True
-                del(self.discoveries[info.server])
+                address = self.discoveries.pop(hostname)
+                self.addresses.pop(hostname, None)
+                self.properties.pop(hostname, None)
+                self.latencies.pop(hostname, None)
+
+                if self.listener and hasattr(self.listener, "remove_device"):
+                    self.listener.remove_device(hostname, address)
@@ -0,0 +1,150 @@
+'''
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import json
+import socket
+import sys
+import threading
+import time
+
+from zeroconf import ServiceBrowser, Zeroconf
+
+from mdt import discoverer
+from mdt import unixsocket
+
+
+IDLE_TIMEOUT_SECS = 600
+
+
+class DiscoveryService:
+    '''Keeps a single mDNS browser running and answers device queries from mdt
+    processes over a unix socket, so that they neither start their own mDNS
+    stacks nor wait for announcements they've already missed.
+
+    Each connection carries one request and one reply, both a line of JSON.
+    Requests look like {"target": <name, "*" or null>, "timeout": <secs>}, and
+    replies like {"devices": {<hostname>: [[<address>, ...], <properties>]}},
+    where properties holds the device's TXT record metadata.'''
+
+    def __init__(self):
+        self.devices = {}
+        self.hostnames = {}
+        self.condition = threading.Condition()
+        self.started = time.time()
+        self.lastAnnouncement = self.started
+        self.resolver = None
+        self.server = unixsocket.Server(discoverer.DISCOVERY_SOCKET_PATH,
+                                        discoverer.DISCOVERY_SERVICE_NAME,
+                                        self._serve, IDLE_TIMEOUT_SECS)
+
+    def _serviceResolved(self, name, info):
+        addresses = discoverer.ServiceAddresses(info)
+        if not addresses:
+            return
+
+        hostname = info.server.split('.')[0]
+        with self.condition:
+            self.devices[hostname] = (addresses,
+                                      discoverer.ServiceProperties(info))
+            self.hostnames[name] = hostname
+            self.lastAnnouncement = time.time()
+            self.condition.notify_all()
+
+    def add_service(self, zeroconf, type, name):
+        with self.condition:
+            self.lastAnnouncement = time.time()
+        self.resolver.resolve(type, name)
+
+    update_service = add_service
+
+    def remove_service(self, zeroconf, type, name):
+        with self.condition:
+            hostname = self.hostnames.pop(name, None)
+            if hostname in self.devices:
+                del self.devices[hostname]
+            self.lastAnnouncement = time.time()
+            self.condition.notify_all()
+
+    def _settled(self):
+        # Mirrors Discoverer.discover(): the table is complete once
+        # announcements have stopped for a period, or we've waited long enough.
+        now = time.time()
+        period = discoverer.Discoverer.ANNOUNCE_PERIOD_SECS
+        return ((now - self.lastAnnouncement >= period and
+                 not self.resolver.busy()) or
+                now - self.started >= period *
+                discoverer.Discoverer.MAXIMUM_WAIT_CYCLES)
+
+    def _matches(self, target):
+        if target == '*':
+            return bool(self.devices)
+        return target in self.devices
+
+    def query(self, target, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while not (self._matches(target) or self._settled()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(
+                    min(remaining, discoverer.Discoverer.ANNOUNCE_PERIOD_SECS))
+            return dict(self.devices)
+
+    def _serve(self, conn):
+        try:
+            with conn.makefile('rb') as fp:
+                request = json.loads(fp.readline().decode('utf-8'))
+            devices = self.query(request.get('target'),
+                                 float(request.get('timeout', 0)))
+            reply = {'devices': devices}
+            conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except (socket.error, ValueError, AttributeError):
+            pass
+
+    def run(self):
+        zeroconf = None
+        browser = None
+        try:
+            self.server.listen()
+            zeroconf = Zeroconf()
+            self.resolver = discoverer.ServiceResolver(zeroconf,
+                                                       self._serviceResolved)
+            browser = ServiceBrowser(zeroconf,
+                                     discoverer.Discoverer.SERVICE_TYPE, self)
+            self.server.serve()
+            return 0
+        finally:
+            self.server.close()
+            if browser:
+                browser.cancel()
+            if self.resolver:
+                self.resolver.close()
+            if zeroconf:
+                zeroconf.close()
+
+
+def main():
+    try:
+        return DiscoveryService().run()
+    except (unixsocket.ServerError, socket.error) as e:
+        sys.stderr.write('{0}\n'.format(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
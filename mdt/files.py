@@ -83,9 +83,8 @@ dependencies.
         remote_filename = os.path.join('/tmp', package_filename)
 
         sftp_callback = MakeProgressFunc(package_filename, PROGRESS_WIDTH)
-        sftp = client.openSftp()
-        sftp.put(package_to_install, remote_filename, callback=sftp_callback)
-        sftp.close()
+        self.runWithDevice(client, lambda device: device.put(
+            package_to_install, remote_filename, sftp_callback))
         client.close()
         print()
 
@@ -126,24 +125,23 @@ Pushes (copies) a local file or set of files to the remote device.
 
         return True
 
-    def runWithClient(self, client, args):
-        files_to_push = args[1:-1]
-        destination = args[-1]
+    async def _push(self, device, files_to_push, destination):
+        for file in files_to_push:
+            base_filename = os.path.basename(file)
+            sftp_callback = MakeProgressFunc(file, PROGRESS_WIDTH)
+            remote_filename = os.path.join(destination, base_filename)
+
+            sftp_callback(0, 1)
+            await device.put(file, remote_filename, sftp_callback)
+            sftp_callback(1, 1)
+            print()
 
+    def runWithClient(self, client, args):
         try:
-            sftp = client.openSftp()
-            for file in files_to_push:
-                base_filename = os.path.basename(file)
-                sftp_callback = MakeProgressFunc(file, PROGRESS_WIDTH)
-                remote_filename = os.path.join(destination, base_filename)
-
-                sftp_callback(0, 1)
-                sftp.put(file, remote_filename, callback=sftp_callback)
-                sftp_callback(1, 1)
-                print()
+            self.runWithDevice(client, lambda device: self._push(
+                device, args[1:-1], args[-1]))
         finally:
             print()
-            sftp.close()
 
         return 0
 
@@ -173,25 +171,24 @@ Pulls (copies) a set of files from the remote device to a local path.
 
         return True
 
-    def runWithClient(self, client, args):
-        files_to_pull = args[1:-1]
-        destination = args[-1]
+    async def _pull(self, device, files_to_pull, destination):
+        for file in files_to_pull:
+            base_filename = os.path.basename(file)
+            sftp_callback = MakeProgressFunc(file,
+                                             PROGRESS_WIDTH,
+                                             char='<')
+            destination_filename = os.path.join(destination, base_filename)
+
+            sftp_callback(0, 1)
+            await device.get(file, destination_filename, sftp_callback)
+            sftp_callback(1, 1)
+            print()
 
+    def runWithClient(self, client, args):
         try:
-            sftp = client.openSftp()
-            for file in files_to_pull:
-                base_filename = os.path.basename(file)
-                sftp_callback = MakeProgressFunc(file,
-                                                 PROGRESS_WIDTH,
-                                                 char='<')
-                destination_filename = os.path.join(destination, base_filename)
-
-                sftp_callback(0, 1)
-                sftp.get(file, destination_filename, callback=sftp_callback)
-                sftp_callback(1, 1)
-                print()
+            self.runWithDevice(client, lambda device: self._pull(
+                device, args[1:-1], args[-1]))
         finally:
             print()
-            sftp.close()
 
         return 0
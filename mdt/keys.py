@@ -15,6 +15,7 @@ limitations under the License.
 '''
 
 
+import binascii
 import os
 import platform
 import shutil
@@ -23,8 +24,15 @@ import sys
 
 import paramiko
 from paramiko.ssh_exception import SSHException, PasswordRequiredException
+from paramiko.ecdsakey import ECDSAKey
 from paramiko.rsakey import RSAKey
 
+# Ed25519 keys need paramiko v2.2 or newer.
+try:
+    from paramiko.ed25519key import Ed25519Key
+except ImportError:
+    Ed25519Key = None
+
 from mdt import config
 
 
@@ -36,73 +44,199 @@ SUPPORTED_SYSTEMS = [
 
 KEYSDIR = os.path.join(config.CONFIG_BASEDIR, "keys")
 KEYFILE_PATH = os.path.join(config.CONFIG_BASEDIR, "keys", "mdt.key")
+AUTHSTATE_PATH = os.path.join(config.CONFIG_BASEDIR, "keys", "authstate")
+
+
+KEY_TYPES = ['rsa', 'ecdsa', 'ed25519']
+RSA_KEY_BITS = 4096
+ECDSA_KEY_BITS = 256
+
+
+class KeystoreError(Exception):
+    pass
 
 
 def GenerateAuthorizedKeysLine(paramiko_key):
     public_key = paramiko_key.get_base64()
-    authorized_keys_line = 'ssh-rsa {0} mdt\r\n'.format(public_key)
+    authorized_keys_line = '{0} {1} mdt\r\n'.format(paramiko_key.get_name(),
+                                                      public_key)
     return authorized_keys_line
 
 
+def LoadPrivateKey(keyfile):
+    key_classes = [RSAKey, ECDSAKey]
+    if Ed25519Key:
+        key_classes.append(Ed25519Key)
+
+    error = None
+    for key_class in key_classes:
+        try:
+            return key_class.from_private_key_file(keyfile)
+        except PasswordRequiredException:
+            raise
+        except SSHException as e:
+            error = e
+
+    raise error
+
+
+def _generateEd25519Key(keyfile):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+    # Paramiko can load Ed25519 keys, but can neither generate nor write them,
+    # so let cryptography produce an OpenSSH format key file for it.
+    key_data = Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption())
+
+    fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as fp:
+        fp.write(key_data)
+
+    return Ed25519Key.from_private_key_file(keyfile)
+
+
+def HostKeyFingerprint(paramiko_key):
+    return binascii.hexlify(paramiko_key.get_fingerprint()).decode('ascii')
+
+
+class AuthStateCache:
+    '''Remembers which devices have accepted the MDT key, along with the
+    fingerprint of the host key they presented at the time.
+
+    This doesn't shorten authentication: every connection tries the MDT key
+    first regardless. It only decides whether a multiplexer master may be
+    started for a device, and whether a USB probe may keep a cached name.'''
+
+    def __init__(self):
+        self.entries = self._read()
+
+    def _read(self):
+        entries = {}
+        if os.path.exists(AUTHSTATE_PATH):
+            with open(AUTHSTATE_PATH, "r") as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        entries[fields[0]] = fields[1]
+        return entries
+
+    def _update(self, change):
+        # Several clients, in this process or others, may be updating the
+        # file at once, so merge our change into whatever it holds now.
+        if not os.path.exists(KEYSDIR):
+            os.makedirs(KEYSDIR, mode=0o700, exist_ok=True)
+        with config.FileLock(AUTHSTATE_PATH):
+            self.entries = self._read()
+            change(self.entries)
+            config.WriteFileAtomically(AUTHSTATE_PATH, "".join(
+                "{0} {1}\n".format(device, fingerprint)
+                for device, fingerprint in sorted(self.entries.items())))
+
+    def isKnownGood(self, device, fingerprint=None):
+        if fingerprint is None:
+            return device in self.entries
+        return self.entries.get(device) == fingerprint
+
+    def markGood(self, device, fingerprint):
+        def change(entries):
+            entries[device] = fingerprint
+
+        if self.entries.get(device) != fingerprint:
+            self._update(change)
+
+    def invalidate(self, device=None):
+        def change(entries):
+            if device is None:
+                entries.clear()
+            else:
+                entries.pop(device, None)
+
+        if (device is None and self.entries) or device in self.entries:
+            self._update(change)
+
+
 class Keystore:
     def __init__(self):
         if not os.path.exists(config.CONFIG_BASEDIR):
-            os.makedirs(CONFIG_BASEDIR, mode=0o700)
+            os.makedirs(config.CONFIG_BASEDIR, mode=0o700)
         if not os.path.exists(KEYSDIR):
             os.makedirs(KEYSDIR, mode=0o700)
         if not os.path.exists(KEYFILE_PATH):
             self.pkey = None
         else:
             try:
-                self.pkey = RSAKey.from_private_key_file(KEYFILE_PATH)
+                self.pkey = LoadPrivateKey(KEYFILE_PATH)
             except IOError as e:
-                print("Unable to read private key from file: {0}".format(e))
-                sys.exit(1)
-            except PasswordRequiredException as e:
-                print("Unable to load in private key: {0}".format(e))
-                sys.exit(1)
+                raise KeystoreError(
+                    "Unable to read private key from file: {0}".format(e))
+            except SSHException as e:
+                raise KeystoreError(
+                    "Unable to load in private key: {0}".format(e))
 
-    def generateKey(self):
-        self.pkey = RSAKey.generate(bits=4096)
+    def generateKey(self, keytype=None):
+        if not keytype:
+            keytype = config.Config().keyType()
 
         try:
-            self.pkey.write_private_key_file(KEYFILE_PATH)
+            if keytype == 'rsa':
+                self.pkey = RSAKey.generate(bits=RSA_KEY_BITS)
+                self.pkey.write_private_key_file(KEYFILE_PATH)
+            elif keytype == 'ecdsa':
+                self.pkey = ECDSAKey.generate(bits=ECDSA_KEY_BITS)
+                self.pkey.write_private_key_file(KEYFILE_PATH)
+            elif keytype == 'ed25519' and Ed25519Key:
+                self.pkey = _generateEd25519Key(KEYFILE_PATH)
+            else:
+                raise KeystoreError(
+                    "Unsupported key type '{0}'.".format(keytype))
         except IOError as e:
-            print("Unable to write private key to disk: {0}".format(e))
-            return False
-        else:
-            return True
+            raise KeystoreError(
+                "Unable to write private key to disk: {0}".format(e))
+
+        # No device has seen this key yet.
+        AuthStateCache().invalidate()
+        return True
 
     def importKey(self, keyfile):
         try:
-            self.pkey = RSAKey.from_private_key_file(keyfile)
+            self.pkey = LoadPrivateKey(keyfile)
         except IOError as e:
-            print("Unable to read private key from file: {0}".format(e))
-            return False
+            raise KeystoreError(
+                "Unable to read private key from file: {0}".format(e))
         except PasswordRequiredException as e:
-            print("Unable to load in private key: {0}".format(e))
-            return False
+            raise KeystoreError("Unable to load in private key: {0}".format(e))
         except SSHException as e:
-            print("Unable to import private key: {0}".format(e))
-            print("Note: Only OpenSSH keys generated using ssh-keygen in PEM format are supported.")
-            return False
+            raise KeystoreError(
+                "Unable to import private key: {0}\n"
+                "Note: Only RSA, ECDSA and Ed25519 keys generated using "
+                "ssh-keygen are supported.".format(e))
 
         try:
-            self.pkey.write_private_key_file(KEYFILE_PATH)
+            if Ed25519Key and isinstance(self.pkey, Ed25519Key):
+                shutil.copyfile(keyfile, KEYFILE_PATH)
+                os.chmod(KEYFILE_PATH, 0o600)
+            else:
+                self.pkey.write_private_key_file(KEYFILE_PATH)
         except IOError as e:
-            print("Unable to write private key to disk: {0}".format(e))
-            return False
-        else:
-            return True
+            raise KeystoreError(
+                "Unable to write private key to disk: {0}".format(e))
+
+        AuthStateCache().invalidate()
+        return True
 
     def key(self):
         return self.pkey
 
 
 class GenKeyCommand:
-    '''Usage: mdt genkey
+    '''Usage: mdt genkey [rsa|ecdsa|ed25519]
 
-Generates an SSH key and stores it to disk.
+Generates an SSH key and stores it to disk. If no key type is given, the type
+stored in the 'key-type' variable is used, which defaults to 'rsa'. Ed25519 and
+ECDSA keys are much faster to generate and to authenticate with than RSA keys.
 
 Note that this does not prompt if you want to replace an already existing
 key and will happily overwrite without telling you! Also note, you should remove
@@ -112,6 +246,14 @@ keys.
 '''
 
     def run(self, args):
+        if len(args) > 2 or (len(args) == 2 and args[1] not in KEY_TYPES):
+            print("Usage: mdt genkey [rsa|ecdsa|ed25519]")
+            return 1
+
+        keytype = None
+        if len(args) == 2:
+            keytype = args[1]
+
         if os.path.exists(KEYFILE_PATH):
             print('WARNING!')
             print()
@@ -136,8 +278,11 @@ keys.
             print('Proceeding.')
             os.unlink(KEYFILE_PATH)
 
-        keystore = Keystore()
-        if not keystore.generateKey():
+        try:
+            keystore = Keystore()
+            keystore.generateKey(keytype)
+        except KeystoreError as e:
+            print(e)
             return 1
 
         return 0
@@ -147,7 +292,7 @@ class SetKeyCommand:
     '''Usage: mdt setkey <path-to-private-key>
 
 Copies an SSH private key provided into the MDT key store for use with
-authentication later.'''
+authentication later. RSA, ECDSA and Ed25519 keys are supported.'''
 
     def run(self, args):
         if len(args) != 2:
@@ -159,8 +304,11 @@ authentication later.'''
             print("Can't copy {0}: no such file or directory.".format(source_keyfile))
             return 1
 
-        keystore = Keystore()
-        if not keystore.importKey(source_keyfile):
+        try:
+            keystore = Keystore()
+            keystore.importKey(source_keyfile)
+        except KeystoreError as e:
+            print(e)
             return 1
 
         print("Key {0} imported.".format(source_keyfile))
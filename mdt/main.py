@@ -21,24 +21,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import socket
+import importlib
 import sys
 
-try:
-    import paramiko
-    import zeroconf
-except ImportError:
-    sys.stderr.write("Couldn't load paramiko or zeroconf -- "
-                     "perhaps you need to install them?\r\n")
-    sys.stderr.write("On Debian derivatives, 'apt-get install "
-                     "python3-paramiko python3-zeroconf'.\r\n")
-    sys.exit(1)
-
-from mdt import config
-from mdt import devices
-from mdt import files
-from mdt import keys
-from mdt import shell
 import mdt
 
 
@@ -69,6 +54,7 @@ Where <subcommand> may be one of the following:
     get               - gets an MDT variable value
     set               - sets an MDT variable value
     clear             - clears an MDT variable
+    profile           - shows or sets per-device settings
     genkey            - generates an SSH key for connecting to a device
     pushkey           - pushes an SSH public key to a device
     setkey            - imports a PEM-format SSH private key into the MDT
@@ -86,6 +72,14 @@ Where <subcommand> may be one of the following:
     reboot-bootloader - reboots a device into the bootloader
     version           - prints which version of MDT this is
 
+Subcommands that connect to a device also accept these options right after the
+subcommand name:
+    --profile <name>  - picks the connection profile to use: one of usb-fast,
+                        wifi, slow-link or auto.
+    --trace           - prints how long each phase of the command took. Setting
+                        MDT_TRACE=1 does the same, and MDT_TRACE_FILE=<path>
+                        also appends the timings to <path> as JSON lines.
+
 Use "mdt help <subcommand>" for more details.
 '''
 
@@ -105,7 +99,7 @@ of subcommands available.
         subcommand = args[1].lower()
 
         if subcommand in COMMANDS:
-            command = COMMANDS[subcommand]
+            command = COMMANDS[subcommand]()
             if command.__doc__:
                 print(command.__doc__)
             else:
@@ -125,32 +119,50 @@ Prints the MDT version.
         print("MDT version {0}".format(mdt.__version__))
 
 
+def LazyCommand(module, name):
+    '''Returns a factory for the command class called name in the mdt module
+    given, which is only imported once the factory is called.'''
+
+    def factory():
+        return getattr(importlib.import_module('mdt.' + module), name)
+    return factory
+
+
+# Commands are only imported when they're run, so that ones which never talk to
+# a device don't pay for loading paramiko and zeroconf.
 COMMANDS = {
-    'clear': config.ClearCommand(),
-    'devices': devices.DevicesCommand(),
-    'exec': shell.ExecCommand(),
-    'genkey': keys.GenKeyCommand(),
-    'get': config.GetCommand(),
-    'help': HelpCommand(),
-    'install': files.InstallCommand(),
-    'pull': files.PullCommand(),
-    'push': files.PushCommand(),
-    'pushkey': shell.PushKeyCommand(),
-    'reboot': shell.RebootCommand(),
-    'reboot-bootloader': shell.RebootBootloaderCommand(),
-    'resetkeys': shell.ResetKeysCommand(),
-    'set': config.SetCommand(),
-    'setkey': keys.SetKeyCommand(),
-    'shell': shell.ShellCommand(),
-    'wait-for-device': devices.DevicesWaitCommand(),
-    'version': VersionCommand(),
+    'clear': LazyCommand('config', 'ClearCommand'),
+    'devices': LazyCommand('devices', 'DevicesCommand'),
+    'exec': LazyCommand('shell', 'ExecCommand'),
+    'genkey': LazyCommand('keys', 'GenKeyCommand'),
+    'get': LazyCommand('config', 'GetCommand'),
+    'help': lambda: HelpCommand,
+    'install': LazyCommand('files', 'InstallCommand'),
+    'profile': LazyCommand('config', 'ProfileCommand'),
+    'pull': LazyCommand('files', 'PullCommand'),
+    'push': LazyCommand('files', 'PushCommand'),
+    'pushkey': LazyCommand('shell', 'PushKeyCommand'),
+    'reboot': LazyCommand('shell', 'RebootCommand'),
+    'reboot-bootloader': LazyCommand('shell', 'RebootBootloaderCommand'),
+    'resetkeys': LazyCommand('shell', 'ResetKeysCommand'),
+    'set': LazyCommand('config', 'SetCommand'),
+    'setkey': LazyCommand('keys', 'SetKeyCommand'),
+    'shell': LazyCommand('shell', 'ShellCommand'),
+    'wait-for-device': LazyCommand('devices', 'DevicesWaitCommand'),
+    'version': lambda: VersionCommand,
 }
 
 
+def LoadCommand(name):
+    '''Imports and constructs the command called name.'''
+
+    return COMMANDS[name]()()
+
+
 def main():
     try:
         if len(sys.argv) <= 1:
-            exit(COMMANDS['help'].run([]))
+            exit(LoadCommand('help').run([]))
         else:
             command = sys.argv[1].lower()
 
@@ -158,12 +170,21 @@ def main():
             command = 'help'
 
         if command in COMMANDS:
-            command = COMMANDS[command]
+            command = LoadCommand(command)
             exit(command.run(sys.argv[1:]))
 
         print("Unknown command '{0}': try 'mdt help'".format(command))
         return 1
 
+    except ImportError as e:
+        if e.name not in ('paramiko', 'zeroconf'):
+            raise
+        sys.stderr.write("Couldn't load paramiko or zeroconf -- "
+                         "perhaps you need to install them?\r\n")
+        sys.stderr.write("On Debian derivatives, 'apt-get install "
+                         "python3-paramiko python3-zeroconf'.\r\n")
+        sys.exit(1)
+
     except KeyboardInterrupt:
         print()
         exit(1)
@@ -0,0 +1,609 @@
+'''
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import json
+import os
+import queue
+import select
+import shutil
+import socket
+import struct
+import sys
+import threading
+
+import paramiko
+from paramiko import pipe
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.ssh_exception import SSHException
+
+from mdt import config
+from mdt import keys
+from mdt import sshclient
+from mdt import trace
+from mdt import unixsocket
+
+
+CONTROL_DIR = os.path.join(config.CONFIG_BASEDIR, "control")
+MASTER_STARTUP_TIMEOUT_SECS = 30
+
+# How much client input the master holds for a channel whose remote window is
+# full. Clients may have at most this much data that the master hasn't
+# acknowledged with MSG_ACK yet, so the master never has to stop reading them.
+SEND_BUFFER_LIMIT = 262144
+
+# Each unix socket connection to the master carries exactly one SSH channel.
+# Messages are framed as a one byte type followed by a four byte length. The
+# MSG_OK that accepts a connection carries PROTOCOL_VERSION, so that clients
+# can tell a master left running by an older MDT apart, then a space and the
+# connection profile the master's connection was made with.
+PROTOCOL_VERSION = b'3'
+MSG_OK = 0
+MSG_ERROR = 1
+MSG_PTY = 2
+MSG_SHELL = 3
+MSG_EXEC = 4
+MSG_SUBSYSTEM = 5
+MSG_RESIZE = 6
+MSG_DATA = 7
+MSG_STDERR = 8
+MSG_EOF = 9
+MSG_EXIT = 10
+MSG_ACK = 11
+
+HEADER = struct.Struct('!BI')
+EXIT_STATUS = struct.Struct('!i')
+ACK = struct.Struct('!I')
+
+
+class MultiplexError(Exception):
+    pass
+
+
+def IsSupported():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def ControlSocketPath(device):
+    return os.path.join(CONTROL_DIR, '{0}.sock'.format(device))
+
+
+def SendMessage(sock, msgtype, payload=b''):
+    sock.sendall(HEADER.pack(msgtype, len(payload)) + payload)
+
+
+def _recvExactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def ReceiveMessage(sock):
+    msgtype, length = HEADER.unpack(_recvExactly(sock, HEADER.size))
+    return msgtype, _recvExactly(sock, length)
+
+
+class MultiplexMaster:
+    def __init__(self, device, address, profile=None, addresses=None):
+        self.config = config.Config()
+        self.device = device
+        self.address = address
+        self.addresses = addresses
+        self.profile = profile or self.config.connectionProfile(device)
+        self.server = unixsocket.Server(
+            ControlSocketPath(device), 'multiplexer for {0}'.format(device),
+            self._serve, int(self.config.multiplexIdleTimeout()))
+        self.client = None
+        self.lock = threading.Lock()
+
+    def _transport(self):
+        with self.lock:
+            transport = None
+            if self.client:
+                transport = self.client.transport
+
+            if not transport or not transport.is_active():
+                if self.client:
+                    self.client.close()
+                self.client = sshclient.SshClient(self.device, self.address,
+                                                  self.profile,
+                                                  addresses=self.addresses)
+                transport = self.client.connect(allowKeyPush=False)
+                transport.set_keepalive(sshclient.KEEP_ALIVE_SECS)
+
+            return transport
+
+    def _request(self, conn, channel, msgtype, payload):
+        try:
+            if msgtype == MSG_PTY:
+                pty = json.loads(payload.decode('utf-8'))
+                channel.get_pty(term=pty['term'],
+                                width=pty['width'],
+                                height=pty['height'])
+            elif msgtype == MSG_SHELL:
+                channel.invoke_shell()
+            elif msgtype == MSG_EXEC:
+                channel.exec_command(payload.decode('utf-8'))
+            elif msgtype == MSG_SUBSYSTEM:
+                channel.invoke_subsystem(payload.decode('utf-8'))
+            else:
+                raise SSHException('Unknown request {0}'.format(msgtype))
+        except SSHException as e:
+            SendMessage(conn, MSG_ERROR, str(e).encode('utf-8'))
+        else:
+            SendMessage(conn, MSG_OK)
+
+    def _pump(self, conn, channel):
+        # Input from the client is buffered rather than sent with a blocking
+        # sendall, so that we keep reading the device's output while its
+        # window is full. Otherwise a device that stops reading its input until
+        # we take its output would deadlock with us.
+        channel.settimeout(0)
+        pending = bytearray()
+        eof = False
+
+        while True:
+            readers = [channel]
+            if len(pending) < SEND_BUFFER_LIMIT:
+                readers.append(conn)
+            timeout = sshclient.SEND_RETRY_SECS if pending else None
+            read, write, exception = select.select(readers, [], [], timeout)
+
+            if channel in read:
+                while channel.recv_stderr_ready():
+                    SendMessage(conn, MSG_STDERR, channel.recv_stderr(
+                        sshclient.RECV_BUFFER_SIZE))
+                if channel.recv_ready():
+                    SendMessage(conn, MSG_DATA,
+                                channel.recv(sshclient.RECV_BUFFER_SIZE))
+                elif channel.eof_received or channel.closed:
+                    status = channel.recv_exit_status()
+                    SendMessage(conn, MSG_EXIT, EXIT_STATUS.pack(status))
+                    return
+
+            if conn in read:
+                msgtype, payload = ReceiveMessage(conn)
+                if msgtype == MSG_DATA:
+                    pending += payload
+                elif msgtype == MSG_EOF:
+                    eof = True
+                elif msgtype == MSG_RESIZE:
+                    size = json.loads(payload.decode('utf-8'))
+                    channel.resize_pty(width=size['width'],
+                                       height=size['height'])
+                else:
+                    self._request(conn, channel, msgtype, payload)
+
+            # Once the command has closed the channel, input for it has
+            # nowhere to go, so it's dropped, and acknowledged all the same.
+            acked = 0
+            if channel.closed or channel.eof_received:
+                acked = len(pending)
+                del pending[:]
+                eof = False
+            while pending and channel.send_ready():
+                try:
+                    sent = channel.send(
+                        bytes(pending[:sshclient.RECV_BUFFER_SIZE]))
+                except socket.timeout:
+                    break
+                except socket.error:
+                    sent = len(pending)
+                    eof = False
+                if not sent:
+                    break
+                del pending[:sent]
+                acked += sent
+            if acked:
+                SendMessage(conn, MSG_ACK, ACK.pack(acked))
+
+            if eof and not pending:
+                channel.shutdown_write()
+                eof = False
+
+    def _serve(self, conn):
+        channel = None
+        try:
+            try:
+                channel = self._transport().open_session()
+            except Exception as e:
+                SendMessage(conn, MSG_ERROR, str(e).encode('utf-8'))
+                return
+
+            SendMessage(conn, MSG_OK, PROTOCOL_VERSION + b' ' +
+                        self.profile.encode('utf-8'))
+            self._pump(conn, channel)
+        except (EOFError, SSHException, socket.error):
+            pass
+        finally:
+            if channel:
+                channel.close()
+
+    def run(self):
+        self.server.listen()
+        try:
+            self._transport()
+            self.server.serve()
+            return 0
+        finally:
+            self.server.close()
+            if self.client:
+                self.client.close()
+
+
+class MultiplexTransport:
+    '''Stands in for a paramiko Transport on the client side of a multiplexed
+    channel. Keepalives are handled by the master process.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def set_keepalive(self, interval):
+        pass
+
+    def is_active(self):
+        return True
+
+
+class MultiplexChannel:
+    '''A paramiko Channel look-alike that proxies a single SSH channel through
+    a MultiplexMaster over a unix socket. Its send window is the room left in
+    the master's buffer for the channel, rather than the remote window itself.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.transport = MultiplexTransport(sock)
+        self.timeout = None
+        self.closed = False
+        self.eof_received = False
+        self.exit_status = -1
+        self.status_event = threading.Event()
+        self.in_buffer = BufferedPipe()
+        self.in_stderr_buffer = BufferedPipe()
+        self.replies = queue.Queue()
+        self.sendLock = threading.Lock()
+        self.sendCondition = threading.Condition()
+        self.sendWindow = SEND_BUFFER_LIMIT
+        self.sendClosed = False
+        self.eofSent = False
+        self._pipe = None
+
+        self.reader = threading.Thread(target=self._readLoop)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _readLoop(self):
+        try:
+            while True:
+                msgtype, payload = ReceiveMessage(self.sock)
+                if msgtype == MSG_DATA:
+                    self.in_buffer.feed(payload)
+                elif msgtype == MSG_STDERR:
+                    self.in_stderr_buffer.feed(payload)
+                elif msgtype == MSG_ACK:
+                    with self.sendCondition:
+                        self.sendWindow += ACK.unpack(payload)[0]
+                        self.sendCondition.notify_all()
+                elif msgtype == MSG_EXIT:
+                    self.exit_status = EXIT_STATUS.unpack(payload)[0]
+                    break
+                elif msgtype in (MSG_OK, MSG_ERROR):
+                    self.replies.put((msgtype, payload))
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.eof_received = True
+            with self.sendCondition:
+                self.sendClosed = True
+                self.sendCondition.notify_all()
+            self.status_event.set()
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            self.replies.put((MSG_ERROR, b'Connection to multiplexer closed'))
+
+    def _send(self, msgtype, payload=b''):
+        with self.sendLock:
+            SendMessage(self.sock, msgtype, payload)
+
+    def _request(self, msgtype, payload=b''):
+        self._send(msgtype, payload)
+        reply, message = self.replies.get()
+        if reply == MSG_ERROR:
+            raise SSHException(message.decode('utf-8'))
+
+    def get_name(self):
+        return 'mux'
+
+    def get_transport(self):
+        return self.transport
+
+    def get_pty(self, term='vt100', width=80, height=24):
+        pty = {'term': term, 'width': width, 'height': height}
+        self._request(MSG_PTY, json.dumps(pty).encode('utf-8'))
+
+    def invoke_shell(self):
+        self._request(MSG_SHELL)
+
+    def exec_command(self, command):
+        self._request(MSG_EXEC, command.encode('utf-8'))
+
+    def invoke_subsystem(self, subsystem):
+        self._request(MSG_SUBSYSTEM, subsystem.encode('utf-8'))
+
+    def resize_pty(self, width=80, height=24, width_pixels=0, height_pixels=0):
+        size = {'width': width, 'height': height}
+        self._send(MSG_RESIZE, json.dumps(size).encode('utf-8'))
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, blocking):
+        self.settimeout(None if blocking else 0.0)
+
+    def fileno(self):
+        if self._pipe is None:
+            self._pipe = pipe.make_pipe()
+            p1, p2 = pipe.make_or_pipe(self._pipe)
+            self.in_buffer.set_event(p1)
+            self.in_stderr_buffer.set_event(p2)
+        return self._pipe.fileno()
+
+    def recv(self, nbytes):
+        try:
+            return self.in_buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_stderr(self, nbytes):
+        try:
+            return self.in_stderr_buffer.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_ready(self):
+        return self.in_buffer.read_ready()
+
+    def recv_stderr_ready(self):
+        return self.in_stderr_buffer.read_ready()
+
+    def send_ready(self):
+        with self.sendCondition:
+            return self.sendClosed or self.eofSent or self.sendWindow > 0
+
+    def send(self, data):
+        # Like Channel.send: waits up to the timeout for room in the window,
+        # and sends as much of data as fits.
+        with self.sendCondition:
+            if self.eofSent:
+                return 0
+            ready = self.sendCondition.wait_for(
+                lambda: self.sendClosed or self.sendWindow > 0, self.timeout)
+            if self.sendClosed:
+                raise socket.error('Socket is closed')
+            if not ready:
+                raise socket.timeout()
+            size = min(len(data), self.sendWindow)
+            self.sendWindow -= size
+
+        self._send(MSG_DATA, bytes(data[:size]))
+        return size
+
+    def sendall(self, data):
+        while data:
+            sent = self.send(data)
+            if not sent:
+                raise socket.error('Socket is closed')
+            data = data[sent:]
+
+    def shutdown_write(self):
+        with self.sendCondition:
+            self.eofSent = True
+        self._send(MSG_EOF)
+
+    def exit_status_ready(self):
+        return self.status_event.is_set()
+
+    def recv_exit_status(self):
+        self.status_event.wait()
+        return self.exit_status
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        if self._pipe is not None:
+            self._pipe.close()
+
+
+class MultiplexClient:
+    '''Drop-in replacement for SshClient that opens its channels through a
+    per-device MultiplexMaster, starting one if none is running yet. Falls back
+    to a direct SshClient if the master can't be used.'''
+
+    def __init__(self, device, address, profile=None, log=None,
+                 addresses=None):
+        self.device = device
+        self.address = address
+        self.addresses = addresses or [address]
+        self.profile = profile or config.Config().connectionProfile(device)
+        self.log = log
+        self.path = ControlSocketPath(device)
+        self.channels = []
+        self.direct = None
+        self.disabled = False
+
+    def _openSocket(self):
+        try:
+            return unixsocket.Connect(self.path)
+        except socket.error:
+            pass
+
+        # The master can't push keys, so let a direct connection take care of
+        # devices that haven't accepted our key yet.
+        if not keys.AuthStateCache().isKnownGood(self.device):
+            raise MultiplexError('{0} has not accepted our key '
+                                 'yet'.format(self.device))
+
+        args = ['mdt.multiplexer', self.device, ','.join(self.addresses),
+                self.profile]
+        try:
+            return unixsocket.Spawn(self.path,
+                                    'multiplexer for {0}'.format(self.device),
+                                    args, MASTER_STARTUP_TIMEOUT_SECS)
+        except unixsocket.ServerError as e:
+            raise MultiplexError(e)
+
+    def _openMultiplexedChannel(self):
+        if self.disabled:
+            raise MultiplexError('Multiplexing disabled for this session')
+
+        try:
+            with trace.Phase('multiplexer-connect'):
+                sock = self._openSocket()
+                sock.settimeout(MASTER_STARTUP_TIMEOUT_SECS)
+                try:
+                    msgtype, payload = ReceiveMessage(sock)
+                except (EOFError, socket.error) as e:
+                    sock.close()
+                    raise MultiplexError(e)
+                sock.settimeout(None)
+
+            if msgtype != MSG_OK:
+                sock.close()
+                raise MultiplexError(payload.decode('utf-8'))
+            version, _, profile = payload.partition(b' ')
+            if version != PROTOCOL_VERSION:
+                sock.close()
+                raise MultiplexError('Multiplexer for {0} is from another '
+                                     'version of MDT'.format(self.device))
+
+            # A running master keeps the profile it was started with, so
+            # connect directly rather than quietly ignore the one asked for.
+            profile = profile.decode('utf-8')
+            if profile != self.profile:
+                sock.close()
+                message = ("Multiplexer for {0} uses the '{1}' connection "
+                           "profile, connecting directly to use '{2}'".format(
+                               self.device, profile, self.profile))
+                if self.log:
+                    self.log(message)
+                raise MultiplexError(message)
+        except MultiplexError:
+            self.disabled = True
+            raise
+
+        channel = MultiplexChannel(sock)
+        self.channels.append(channel)
+        return channel
+
+    def _directClient(self):
+        if not self.direct:
+            self.direct = sshclient.SshClient(self.device, self.address,
+                                              self.profile, self.log,
+                                              self.addresses)
+        return self.direct
+
+    def connect(self, allowKeyPush=True):
+        # Channels are opened through the master on demand, and only fall back
+        # to a direct connection if the master can't be used.
+        if self.direct:
+            return self.direct.connect(allowKeyPush)
+
+    def openShell(self):
+        try:
+            channel = self._openMultiplexedChannel()
+        except MultiplexError:
+            return self._directClient().openShell()
+
+        term = os.getenv("TERM", default="vt100")
+        width, height = shutil.get_terminal_size()
+        channel.get_pty(term=term, width=width, height=height)
+        channel.invoke_shell()
+        return channel
+
+    def openChannel(self, allocPty=False):
+        try:
+            channel = self._openMultiplexedChannel()
+        except MultiplexError:
+            return self._directClient().openChannel(allocPty=allocPty)
+
+        if allocPty:
+            term = os.getenv("TERM", default="vt100")
+            width, height = shutil.get_terminal_size()
+            channel.get_pty(term=term, width=width, height=height)
+
+        return channel
+
+    def shellExec(self, cmd, allocPty=False):
+        channel = self.openChannel(allocPty=allocPty)
+        channel.exec_command(cmd)
+        return channel
+
+    def openSftp(self):
+        try:
+            channel = self._openMultiplexedChannel()
+        except MultiplexError:
+            return self._directClient().openSftp()
+
+        channel.invoke_subsystem('sftp')
+        return paramiko.SFTPClient(channel)
+
+    def pushKey(self):
+        return self._directClient().pushKey()
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        self.channels = []
+
+        if self.direct:
+            self.direct.close()
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        sys.stderr.write('Usage: python3 -m mdt.multiplexer <device> '
+                         '<address>[,<address>...] [<connection-profile>]\n')
+        return 1
+
+    device = sys.argv[1]
+    addresses = sys.argv[2].split(',')
+    profile = None
+    if len(sys.argv) == 4:
+        profile = sys.argv[3]
+
+    try:
+        return MultiplexMaster(device, addresses[0], profile, addresses).run()
+    except (MultiplexError, unixsocket.ServerError, keys.KeystoreError,
+            sshclient.KeyPushError, SSHException, socket.error) as e:
+        sys.stderr.write('{0}\n'.format(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+'''
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+class OptionError(Exception):
+    pass
+
+
+def ParseOptions(args, known_options):
+    '''Strips the --options that come directly after the subcommand name out of
+    args. known_options maps each option name to whether it takes a value.
+    Parsing stops at the first argument that isn't a known option, so that
+    options meant for a remote command are left alone.
+
+    Returns a tuple of (options, remaining_args).'''
+
+    options = {}
+    index = 1
+    while index < len(args):
+        name, equals, value = args[index].partition('=')
+        if name not in known_options:
+            break
+
+        if known_options[name]:
+            if not equals:
+                index += 1
+                if index >= len(args):
+                    raise OptionError('{0} requires a value'.format(name))
+                value = args[index]
+            options[name] = value
+        elif equals:
+            raise OptionError('{0} does not take a value'.format(name))
+        else:
+            options[name] = True
+        index += 1
+
+    return options, args[:1] + args[index:]
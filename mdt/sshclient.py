@@ -17,20 +17,79 @@ limitations under the License.
 
 import http.client
 import os
+import queue
+import shutil
 import socket
+import threading
 import time
 import fnmatch
 
 import paramiko
 from paramiko.ssh_exception import AuthenticationException, SSHException
-from paramiko.client import AutoAddPolicy
 
 from mdt import config
 from mdt import discoverer
 from mdt import keys
-
-
-KEYMASTER_PORT = 41337
+from mdt import trace
+
+
+KEYMASTER_PORT = discoverer.KEYMASTER_PORT
+SSH_PORT = 22
+CONNECT_TIMEOUT_SECS = 10
+USB_SUBNET_PREFIX = discoverer.USB_SUBNET_PREFIX
+
+# Shared by everything that moves a command's data over a channel. Paramiko
+# can't tell us when the remote window opens again, so senders waiting on a
+# full window poll for it every SEND_RETRY_SECS.
+KEEP_ALIVE_SECS = 10
+RECV_BUFFER_SIZE = 32768
+SEND_RETRY_SECS = 0.01
+
+# When a device has several addresses, connection attempts start this far
+# apart, and a USB address that connects within USB_PREFERENCE_SECS of another
+# address wins over it.
+CONNECT_STAGGER_SECS = 0.25
+USB_PREFERENCE_SECS = 0.15
+
+# Bounds on how long key pushing waits for the device at each step. Once a key
+# is pushed, we retry logging in with it starting at RETRY_INITIAL_DELAY_SECS
+# and doubling up to RETRY_MAX_DELAY_SECS, rather than sleeping for a fixed
+# worst case.
+KEYMASTER_TIMEOUT_SECS = 5
+REMOTE_COMMAND_TIMEOUT_SECS = 10
+KEY_READY_TIMEOUT_SECS = 10
+RETRY_INITIAL_DELAY_SECS = 0.05
+RETRY_MAX_DELAY_SECS = 1
+
+# Connection profiles tune a connection for the link it runs over. Cipher and
+# kex lists are preferences: anything else paramiko supports is still offered
+# after them.
+CONNECTION_PROFILES = {
+    # The USB gadget link is fast enough that zlib becomes the bottleneck, so
+    # skip compression, prefer cheap AEAD ciphers and use a large window.
+    'usb-fast': {
+        'compress': False,
+        'ciphers': ['aes128-gcm@openssh.com', 'aes128-ctr'],
+        'kex': ['curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256'],
+        'window-size': 8 * 1024 * 1024,
+        'max-packet-size': 32768,
+    },
+    'wifi': {
+        'compress': True,
+        'ciphers': ['aes128-ctr', 'aes128-gcm@openssh.com'],
+        'kex': ['curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256'],
+        'window-size': 2 * 1024 * 1024,
+        'max-packet-size': 32768,
+    },
+    # Small packets keep interactive traffic responsive behind bulk transfers.
+    'slow-link': {
+        'compress': True,
+        'ciphers': ['aes128-ctr'],
+        'kex': ['curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256'],
+        'window-size': 512 * 1024,
+        'max-packet-size': 8192,
+    },
+}
 
 
 class KeyPushError(Exception):
@@ -45,129 +104,360 @@ class NonLocalDeviceError(Exception):
     pass
 
 
+def IsUsbAddress(address):
+    return address.startswith(USB_SUBNET_PREFIX)
+
+
+def ResolveConnectionProfile(profile, address):
+    if profile == 'auto':
+        if IsUsbAddress(address):
+            return 'usb-fast'
+        return 'wifi'
+    if profile not in CONNECTION_PROFILES:
+        raise SSHException("Unknown connection profile '{0}'".format(profile))
+    return profile
+
+
+def SortAddresses(addresses):
+    '''Orders addresses by preference: the USB link first, then IPv4, then
+    IPv6.'''
+    return sorted(addresses,
+                  key=lambda address: (not IsUsbAddress(address),
+                                       ':' in address))
+
+
+def ConnectFirst(addresses, attempt, discard):
+    '''Calls attempt(address) for every address concurrently, starting the
+    calls CONNECT_STAGGER_SECS apart in SortAddresses order, or as soon as the
+    previous one fails, and returns a tuple of (result, address) for the first
+    call to succeed. A USB address that succeeds shortly after another address
+    wins over it. Results that lose are passed to discard.
+
+    If every attempt fails, raises the most relevant error: an SSHException
+    means the device was reachable, so it wins over a socket.error.'''
+
+    addresses = SortAddresses(addresses)
+    if len(addresses) == 1:
+        return attempt(addresses[0]), addresses[0]
+
+    results = queue.Queue()
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def run(address):
+        try:
+            result = attempt(address)
+        except Exception as e:
+            result = None
+            error = e
+        else:
+            error = None
+
+        with lock:
+            if done.is_set():
+                if result:
+                    discard(result)
+                return
+            results.put((address, result, error))
+
+    waiting = list(addresses)
+    pending = set()
+    winner = None
+    error = None
+    deadline = None
+    next_start = time.time()
+    try:
+        while pending or (waiting and not winner):
+            now = time.time()
+            if waiting and not winner and (now >= next_start or not pending):
+                address = waiting.pop(0)
+                pending.add(address)
+                thread = threading.Thread(target=run, args=(address,))
+                thread.daemon = True
+                thread.start()
+                next_start = now + CONNECT_STAGGER_SECS
+                continue
+
+            wait = None
+            if deadline:
+                wait = max(0, deadline - now)
+            elif waiting:
+                wait = max(0, next_start - now)
+            try:
+                address, result, e = results.get(timeout=wait)
+            except queue.Empty:
+                if deadline:
+                    break
+                continue
+
+            pending.discard(address)
+            if not result:
+                if not isinstance(error, SSHException):
+                    error = e
+                # Don't wait out the stagger once an attempt has failed.
+                next_start = time.time()
+                continue
+
+            if winner and not IsUsbAddress(address):
+                discard(result)
+                continue
+            if winner:
+                discard(winner[0])
+            winner = (result, address)
+
+            if IsUsbAddress(address) or not any(
+                    IsUsbAddress(other) for other in pending.union(waiting)):
+                break
+            deadline = time.time() + USB_PREFERENCE_SECS
+    finally:
+        with lock:
+            done.set()
+        while not results.empty():
+            address, result, e = results.get()
+            if result:
+                discard(result)
+
+    if not winner:
+        raise error
+    return winner
+
+
+def Backoff(timeout, initial=RETRY_INITIAL_DELAY_SECS,
+            maximum=RETRY_MAX_DELAY_SECS):
+    '''Yields exponentially increasing delays to sleep for between retries,
+    stopping once sleeping again would take us past timeout seconds from
+    now.'''
+
+    deadline = time.time() + timeout
+    delay = initial
+    while time.time() + delay < deadline:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+
+def _preferAlgorithms(preferred, available):
+    return tuple([name for name in preferred if name in available] +
+                 [name for name in available if name not in preferred])
+
+
 class SshClient:
-    def __init__(self, device, address):
+    # Status messages (eg: about pushing keys) are passed to log, which
+    # defaults to discarding them, so that the client can be used as a library
+    # without writing to the terminal.
+    #
+    # addresses lists every address the device is known by, if there's more
+    # than one. They're raced against each other on connect, and address is
+    # updated to whichever one won.
+    def __init__(self, device, address, profile=None, log=None,
+                 addresses=None):
         self.config = config.Config()
         self.keystore = keys.Keystore()
+        self.authState = keys.AuthStateCache()
 
         self.device = device
         self.address = address
-
-        self.username = self.config.username()
-        self.password = self.config.password()
+        self.addresses = addresses or [address]
+        self.log = log
+
+        # Settings in the device's profile, if it has one, win over the
+        # global ones.
+        deviceProfile = self.config.deviceProfile(device)
+        self.username = deviceProfile.get('username') or self.config.username()
+        self.password = deviceProfile.get('password') or self.config.password()
+        self.port = int(deviceProfile.get('port', SSH_PORT))
+        self.keyPath = deviceProfile.get('key')
+        self.pkey = None
         self.envWhitelist = self.config.envWhitelist()
 
-        if not self.maybeGenerateSshKeys():
-            return False
+        if not profile:
+            profile = self.config.connectionProfile(device)
+        self.profileName = profile
+        self.profile = ResolveConnectionProfile(profile, address)
+
+        self.transport = None
 
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(AutoAddPolicy())
+        self.maybeGenerateSshKeys()
+
+    def _log(self, message):
+        if self.log:
+            self.log(message)
+
+    def _openTransport(self, address):
+        profile = CONNECTION_PROFILES[
+            ResolveConnectionProfile(self.profileName, address)]
+
+        with trace.Phase('tcp-connect'):
+            sock = socket.create_connection((address, self.port),
+                                            CONNECT_TIMEOUT_SECS)
+        transport = paramiko.Transport(
+            sock,
+            default_window_size=profile['window-size'],
+            default_max_packet_size=profile['max-packet-size'])
+
+        options = transport.get_security_options()
+        options.ciphers = _preferAlgorithms(profile['ciphers'], options.ciphers)
+        options.kex = _preferAlgorithms(profile['kex'], options.kex)
+        transport.use_compression(compress=profile['compress'])
 
-    def shouldPushKey(self):
         try:
-            self.client.connect(
-                self.address,
-                username=self.username,
-                pkey=self.keystore.key(),
-                allow_agent=False,
-                look_for_keys=False,
-                compress=True)
-        except AuthenticationException as e:
-            return True
-        except (SSHException, socket.error) as e:
-            raise e
-        finally:
-            self.client.close()
+            with trace.Phase('kex'):
+                transport.start_client(timeout=CONNECT_TIMEOUT_SECS)
+        except (SSHException, socket.error):
+            transport.close()
+            raise
+
+        # A device that comes back with a different host key was reflashed, and
+        # has forgotten whatever keys we pushed to it before.
+        fingerprint = keys.HostKeyFingerprint(transport.get_remote_server_key())
+        if not self.authState.isKnownGood(self.device, fingerprint):
+            self.authState.invalidate(self.device)
+
+        return transport
+
+    def _connect(self, authenticate):
+        # Races every address the device is known by, keeping the first
+        # transport that authenticates.
+        def attempt(address):
+            transport = self._openTransport(address)
+            try:
+                authenticate(transport)
+            except Exception:
+                transport.close()
+                raise
+            return transport
+
+        self.transport, self.address = ConnectFirst(
+            self.addresses, attempt, lambda transport: transport.close())
+        self.profile = ResolveConnectionProfile(self.profileName, self.address)
+        return self.transport
+
+    def _authenticateWithKey(self, transport):
+        with trace.Phase('auth'):
+            transport.auth_publickey(self.username, self.key())
+
+    def _authenticateWithPassword(self, transport):
+        with trace.Phase('auth-password'):
+            transport.auth_password(self.username, self.password)
+
+    def _connectWithKey(self):
+        transport = self._connect(self._authenticateWithKey)
+        fingerprint = keys.HostKeyFingerprint(transport.get_remote_server_key())
+        self.authState.markGood(self.device, fingerprint)
 
     def _pushKeyViaKeymaster(self):
-        if not self.address:
+        # Keymaster only accepts keys over USB, so use the device's USB address
+        # if it has one, whichever address we last tried to log in on.
+        addresses = [address for address in self.addresses if address]
+        if not addresses:
             raise discoverer.DeviceNotFoundError()
 
-        if not self.address.startswith('192.168.100'):
+        address = SortAddresses(addresses)[0]
+        if not IsUsbAddress(address):
             raise NonLocalDeviceError()
 
-        connection = http.client.HTTPConnection(self.address, KEYMASTER_PORT)
+        connection = http.client.HTTPConnection(address, KEYMASTER_PORT,
+                                                timeout=KEYMASTER_TIMEOUT_SECS)
         try:
-            key_line = keys.GenerateAuthorizedKeysLine(self.keystore.key())
-            connection.request('PUT', '/', key_line + '\r\n')
-            response = connection.getresponse()
+            key_line = keys.GenerateAuthorizedKeysLine(self.key())
+            with trace.Phase('keymaster'):
+                connection.request('PUT', '/', key_line + '\r\n')
+                connection.getresponse().read()
         except ConnectionRefusedError as e:
-            print()
-            print("Couldn't connect to keymaster on {0}: {1}.".format(self.device, e))
-            print()
-            print("Did you previously connect from a different machine? If so,\n"
-                  "mdt-keymaster will not be running as it only accepts a single key.\n")
-            print("You will need to either:\n"
-                  "   1) Remove the key from /home/mendel/.ssh/authorized_keys on the\n"
-                  "      device via the serial console\n"
-                  "\n- or -\n\n"
-                  "   2) Copy the mdt private key from your home directory on this host\n"
-                  "      in ~/.config/mdt/keys/mdt.key to the first machine and use\n"
-                  "      'mdt pushkey mdt.key' to add that key to the device's\n"
-                  "      authorized_keys file.")
-            print()
+            self._log("\n"
+                      "Couldn't connect to keymaster on {0}: {1}.\n"
+                      "\n"
+                      "Did you previously connect from a different machine? If so,\n"
+                      "mdt-keymaster will not be running as it only accepts a single key.\n"
+                      "\n"
+                      "You will need to either:\n"
+                      "   1) Remove the key from /home/mendel/.ssh/authorized_keys on the\n"
+                      "      device via the serial console\n"
+                      "\n- or -\n\n"
+                      "   2) Copy the mdt private key from your home directory on this host\n"
+                      "      in ~/.config/mdt/keys/mdt.key to the first machine and use\n"
+                      "      'mdt pushkey mdt.key' to add that key to the device's\n"
+                      "      authorized_keys file.\n".format(self.device, e))
             raise KeyPushError(e)
-        except ConnectionError as e:
+        except (ConnectionError, socket.timeout, http.client.HTTPException) as e:
             raise KeyPushError(e)
         finally:
             connection.close()
 
+    def _runRemoteCommand(self, transport, cmd):
+        channel = transport.open_session()
+        try:
+            channel.exec_command(cmd)
+            if not channel.status_event.wait(REMOTE_COMMAND_TIMEOUT_SECS):
+                raise KeyPushError('Timed out running {0}'.format(cmd))
+            status = channel.recv_exit_status()
+            if status != 0:
+                raise KeyPushError('{0} exited with code {1}'.format(cmd,
+                                                                    status))
+        finally:
+            channel.close()
+
     def _pushKeyViaDefaultLogin(self):
         try:
-            self.client.connect(
-                    self.address,
-                    username=self.username,
-                    password=self.password,
-                    allow_agent=False,
-                    look_for_keys=False,
-                    compress=True)
+            transport = self._connect(self._authenticateWithPassword)
+            key_line = keys.GenerateAuthorizedKeysLine(self.key())
+            with trace.Phase('install-key'):
+                self._runRemoteCommand(
+                    transport,
+                    'mkdir -p $HOME/.ssh && '
+                    'echo {0} >>$HOME/.ssh/authorized_keys'.format(
+                        key_line.rstrip()))
         except AuthenticationException as e:
             raise DefaultLoginError(e)
         except (SSHException, socket.error) as e:
             raise KeyPushError(e)
-        else:
-            key_line = self._generateAuthorizedKeysLine()
-            self.client.exec_command('mkdir -p $HOME/.ssh')
-            self.client.exec_command(
-                'echo {0} >>$HOME/.ssh/authorized_keys'.format(key_line))
         finally:
-            self.client.close()
+            self.close()
 
     def pushKey(self):
         try:
             self._pushKeyViaKeymaster()
         except KeyPushError as e:
-            print('Failed to push via keymaster -- will attempt password login as a fallback.')
+            self._log('Failed to push via keymaster -- will attempt password '
+                      'login as a fallback.')
             self._pushKeyViaDefaultLogin()
 
-        time.sleep(1)
-
-        # Ensure the key we just pushed allows us to login
-        try:
-            self.client.connect(
-                self.address,
-                username=self.username,
-                pkey=self.keystore.key(),
-                allow_agent=False,
-                look_for_keys=False,
-                compress=True)
-        except AuthenticationException as e:
-            raise KeyPushError(e)
-        except (SSHException, socket.error) as e:
-            raise KeyPushError(e)
-        finally:
-            self.client.close()
+        # Ensure the key we just pushed allows us to login, and keep the
+        # authenticated transport around for whatever the caller does next.
+        # The device may take a moment to pick up the new key, so retry until
+        # it does.
+        delays = Backoff(KEY_READY_TIMEOUT_SECS)
+        with trace.Phase('wait-for-key'):
+            while True:
+                try:
+                    self._connectWithKey()
+                    return
+                except (SSHException, socket.error) as e:
+                    self.close()
+                    delay = next(delays, None)
+                    if delay is None:
+                        raise KeyPushError(e)
+                    time.sleep(delay)
+
+    def key(self):
+        if not self.keyPath:
+            return self.keystore.key()
+
+        if not self.pkey:
+            try:
+                self.pkey = keys.LoadPrivateKey(os.path.expanduser(self.keyPath))
+            except (IOError, SSHException) as e:
+                raise keys.KeystoreError(
+                    "Unable to load private key {0}: {1}".format(self.keyPath,
+                                                                 e))
+        return self.pkey
 
     def maybeGenerateSshKeys(self):
-        if not self.keystore.key():
-            print('Looks like you don\'t have a private key yet. '
-                  'Generating one.')
-
-            if not self.keystore.generateKey():
-                print('Unable to generate private key.')
-                return False
-
-        return True
+        if self.keyPath:
+            return
+        if not self.key():
+            self._log('Looks like you don\'t have a private key yet. '
+                      'Generating one.')
+            self.keystore.generateKey()
 
     def _generateEnvironment(self):
         environment = {}
@@ -177,45 +467,49 @@ class SshClient:
                     environment[name] = value
         return environment
 
+    def connect(self, allowKeyPush=True):
+        # Reuse the existing transport if we're already authenticated, so that
+        # opening several channels only costs a single handshake.
+        if self.transport and self.transport.is_active():
+            return self.transport
+
+        try:
+            self._connectWithKey()
+        except AuthenticationException as e:
+            self.close()
+            self.authState.invalidate(self.device)
+            if not allowKeyPush:
+                raise KeyPushError(e)
+            self._log("Key not present on {0} -- pushing".format(self.device))
+            with trace.Phase('key-push'):
+                self.pushKey()
+
+        return self.transport
+
     def openShell(self):
         term = os.getenv("TERM", default="vt100")
         env = self._generateEnvironment()
-        width, height = os.get_terminal_size()
-
-        if self.shouldPushKey():
-            print("Key not present on {0} -- pushing".format(self.device))
-            self.pushKey()
+        width, height = shutil.get_terminal_size()
 
-        self.client.connect(
-            self.address,
-            username=self.username,
-            pkey=self.keystore.key(),
-            allow_agent=False,
-            look_for_keys=False,
-            compress=True)
+        self.connect()
 
         # FIXME(jtgans): Add environment support once all major distributions we
         # support have added in Paramiko v2.1.x or newer.
-        return self.client.invoke_shell(term=term, width=width, height=height)
+        with trace.Phase('channel-open'):
+            channel = self.transport.open_session()
+            channel.get_pty(term=term, width=width, height=height)
+            channel.invoke_shell()
+        return channel
 
     def openChannel(self, allocPty=False):
-        if self.shouldPushKey():
-            print("Key not present on {0} -- pushing".format(self.device))
-            self.pushKey()
-
-        self.client.connect(
-            self.address,
-            username=self.username,
-            pkey=self.keystore.key(),
-            allow_agent=False,
-            look_for_keys=False,
-            compress=True)
-
-        session = self.client.get_transport().open_session()
-        if allocPty:
-            term = os.getenv("TERM", default="vt100")
-            width, height = os.get_terminal_size()
-            session.get_pty(term=term, width=width, height=height)
+        self.connect()
+
+        with trace.Phase('channel-open'):
+            session = self.transport.open_session()
+            if allocPty:
+                term = os.getenv("TERM", default="vt100")
+                width, height = shutil.get_terminal_size()
+                session.get_pty(term=term, width=width, height=height)
 
         return session
 
@@ -225,20 +519,13 @@ class SshClient:
         return channel
 
     def openSftp(self):
-        if self.shouldPushKey():
-            print("Key not present on {0} -- pushing".format(self.device))
-            self.pushKey()
-
-        self.client.connect(
-            self.address,
-            username=self.username,
-            pkey=self.keystore.key(),
-            allow_agent=False,
-            look_for_keys=False,
-            compress=True)
-
-        session = self.client.open_sftp()
+        self.connect()
+
+        with trace.Phase('sftp-open'):
+            session = paramiko.SFTPClient.from_transport(self.transport)
         return session
 
     def close(self):
-        self.client.close()
+        if self.transport:
+            self.transport.close()
+            self.transport = None
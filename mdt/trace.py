@@ -0,0 +1,113 @@
+'''
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+TRACE_ENV = "MDT_TRACE"
+TRACE_FILE_ENV = "MDT_TRACE_FILE"
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.start = time.time()
+        self.local = threading.local()
+        self.phases = []
+        self.context = {}
+
+    def enable(self, **context):
+        self.enabled = True
+        self.start = time.time()
+        self.phases = []
+        self.context = context
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        # Phases nest per thread, so that commands running against several
+        # devices at once don't skew each other's depth.
+        depth = getattr(self.local, 'depth', 0)
+        record = {
+            'name': name,
+            'depth': depth,
+            'start': time.time() - self.start,
+            'duration': None,
+        }
+        self.phases.append(record)
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            record['duration'] = time.time() - self.start - record['start']
+
+    def report(self, outfile=sys.stderr, **context):
+        if not self.enabled:
+            return
+
+        self.context.update(context)
+
+        total = time.time() - self.start
+        outfile.write('\r\nTrace:\r\n')
+        for record in self.phases:
+            duration = record['duration']
+            if duration is None:
+                duration = total - record['start']
+            outfile.write('  {0:<28} {1:>10.1f} ms  (at {2:.1f} ms)\r\n'.format(
+                '  ' * record['depth'] + record['name'],
+                duration * 1000,
+                record['start'] * 1000))
+        outfile.write('  {0:<28} {1:>10.1f} ms\r\n'.format('total', total * 1000))
+        outfile.flush()
+
+        path = os.environ.get(TRACE_FILE_ENV)
+        if path:
+            entry = dict(self.context)
+            entry['timestamp'] = self.start
+            entry['total'] = total
+            entry['phases'] = self.phases
+            with open(path, 'a') as fp:
+                fp.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+TRACER = Tracer()
+
+
+def RequestedByEnvironment():
+    value = os.environ.get(TRACE_ENV, '').strip().lower()
+    return value not in ('', '0', 'false', 'no')
+
+
+def Enable(**context):
+    TRACER.enable(**context)
+
+
+def Phase(name):
+    return TRACER.phase(name)
+
+
+def Report(**context):
+    TRACER.report(**context)
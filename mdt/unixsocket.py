@@ -0,0 +1,168 @@
+'''
+Copyright 2019 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Background servers that mdt processes share over a unix socket, like the
+connection multiplexers and the discovery service. Each runs in its own
+process, started on demand by the first mdt process that needs it, and exits
+once it has been idle for a while.
+'''
+
+
+import errno
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from mdt import config
+
+
+ACCEPT_POLL_SECS = 1
+SPAWN_POLL_SECS = 0.02
+
+
+class ServerError(Exception):
+    pass
+
+
+def Connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def Spawn(path, name, args, timeout):
+    '''Starts "python -m <args>" in the background, and waits up to timeout
+    seconds for it to listen on path. Returns a socket connected to it.'''
+
+    server = subprocess.Popen(
+        [sys.executable, '-m'] + list(args),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return Connect(path)
+        except socket.error:
+            if server.poll() is not None:
+                raise ServerError('The {0} exited with code {1}'.format(
+                    name, server.returncode))
+            time.sleep(SPAWN_POLL_SECS)
+
+    raise ServerError('Timed out waiting for the {0}'.format(name))
+
+
+class Server:
+    '''Listens on the unix socket at path, and calls handler with each
+    connection on a thread of its own. The connection is closed once handler
+    returns. name describes the server in errors.'''
+
+    def __init__(self, path, name, handler, idle_timeout):
+        self.path = path
+        self.name = name
+        self.handler = handler
+        self.idleTimeout = idle_timeout
+        self.listener = None
+        self.lock = threading.Lock()
+        self.active = 0
+        self.lastActivity = time.time()
+
+    def listen(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, mode=0o700)
+
+        # Bind and listen under a lock, so that a server starting alongside
+        # us can't mistake our socket for a stale one while it's bound but
+        # not yet listening.
+        with config.FileLock(self.path):
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self._bind(listener)
+                listener.listen(16)
+            except Exception:
+                listener.close()
+                raise
+        self.listener = listener
+
+    def _bind(self, listener):
+        try:
+            listener.bind(self.path)
+            return
+        except OSError:
+            pass
+
+        # Either another server owns this socket, or a previous one died
+        # without cleaning up after itself.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error as e:
+            if e.errno == errno.ECONNREFUSED:
+                os.unlink(self.path)
+            elif e.errno != errno.ENOENT:
+                raise
+        else:
+            raise ServerError('A {0} is already running'.format(self.name))
+        finally:
+            probe.close()
+        listener.bind(self.path)
+
+    def _handle(self, conn):
+        try:
+            self.handler(conn)
+        finally:
+            conn.close()
+            with self.lock:
+                self.active -= 1
+                self.lastActivity = time.time()
+
+    def serve(self):
+        '''Accepts connections until none have been open for idle_timeout
+        seconds.'''
+
+        self.listener.settimeout(ACCEPT_POLL_SECS)
+        while True:
+            try:
+                conn, address = self.listener.accept()
+            except socket.timeout:
+                with self.lock:
+                    idle = (not self.active and
+                            time.time() - self.lastActivity > self.idleTimeout)
+                if idle:
+                    return
+                continue
+
+            conn.setblocking(True)
+            with self.lock:
+                self.active += 1
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            os.unlink(self.path)